@@ -0,0 +1,104 @@
+import argparse
+import csv
+import logging
+import os
+import sys
+from conversion.get_info import Get_Info
+import json
+
+
+
+def load_config():
+    with open (os.path.join('/opt/conversion/settings', 'config.json'), 'r') as config_file:
+        config = json.load(config_file)
+        return config
+
+logging.basicConfig(filename=os.path.join('/opt/conversion/logs', 'convert_logs.log'), level=logging.ERROR, format='%(asctime)s:%(message)s')
+
+def parse_bool(value):
+    '''
+    Parse True/False flag from manifest, empty value means flag is not set
+    '''
+    if value is None or isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value == '':
+        return None
+    if value not in ['true', 'false', '1', '0']:
+        raise ValueError(f"Invalid flag {value}. Expected True or False.")
+    return value in ['true', '1']
+
+def read_manifest(lines):
+    '''
+    Read manifest lines. Every line is a JSON object {"path": ..., "is_film": ..., "is_serial": ...},
+    a CSV row path,is_film,is_serial or a plain path. Flags are optional.
+
+    Yields
+    ------
+    tuple
+        (path, is_film, is_serial) where missing flags are None
+    '''
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            if line.startswith('{'):
+                item = json.loads(line)
+                yield item['path'], parse_bool(item.get('is_film')), parse_bool(item.get('is_serial'))
+            elif os.path.exists(line):
+                yield line, None, None
+            else:
+                row = next(csv.reader([line]))
+                if row[0] == 'path':
+                    continue  # header
+                row += [None] * (3 - len(row))
+                yield row[0], parse_bool(row[1]), parse_bool(row[2])
+        except (ValueError, KeyError, IndexError) as e:
+            logging.error(f" Manifest line {line_number} skipped. Error: {e}")
+            print(f"Manifest line {line_number} skipped. Error: {e}")
+
+def expand_paths(get_info, items, storage, default_film, default_serial):
+    '''
+    Expand directories to files and fill missing flags. A flag missing on a manifest line
+    is the complement of the other one, flags missing on both are taken from command line,
+    then from path rules relative to storage directory
+    '''
+    for path, is_film, is_serial in items:
+        if os.path.isdir(path):
+            files = (file_path for file_path, _ in get_info.iter_files(path))
+        elif os.path.isfile(path):
+            files = [path]
+        else:
+            logging.error(f" Attempt to enter file {path} failed. Error: File not found.")
+            print(f"Attempt to enter file {path} failed. Error: File not found.")
+            continue
+
+        for file_path in files:
+            film, serial = is_film, is_serial
+            if film is None and serial is None:
+                film, serial = default_film, default_serial
+            if film is None and serial is not None:
+                film = not serial
+            elif serial is None and film is not None:
+                serial = not film
+            if film is None:
+                depth = os.path.relpath(file_path, storage).count(os.sep)
+                film, serial = get_info.classify_file(storage, file_path, depth)
+            yield file_path, film, serial
+
+parser = argparse.ArgumentParser(description='Add files listed in a manifest (JSONL, CSV or one path per line) to database')
+parser.add_argument('manifest', nargs='?', default='-', help='path to manifest, stdin if omitted or -')
+parser.add_argument('--film', dest='is_film', type=parse_bool, help='True/False, used when manifest line has no is_film')
+parser.add_argument('--serial', dest='is_serial', type=parse_bool, help='True/False, used when manifest line has no is_serial')
+args = parser.parse_args()
+
+config = load_config()
+get_info = Get_Info(config)
+
+manifest = sys.stdin if args.manifest == '-' else open(args.manifest, 'r')
+with manifest:
+    files = expand_paths(get_info, read_manifest(manifest), config['directory'], args.is_film, args.is_serial)
+    get_info.save_files_info(files)
+
+print(f"Added: {get_info.saved_files}, already in database: {get_info.existing_files}, not media: {get_info.skipped_files}")
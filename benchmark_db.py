@@ -0,0 +1,35 @@
+import argparse
+import os
+import sys
+from db_query.benchmark import BENCHMARKS, DbBenchmark
+import json
+
+
+
+def load_config():
+    with open (os.path.join('/opt/conversion/settings', 'config.json'), 'r') as config_file:
+        config = json.load(config_file)
+        return config
+
+parser = argparse.ArgumentParser(description='Time Db_query methods on a synthetic catalog in a temporary sqlite file')
+parser.add_argument('--files', type=int, default=100000, help='number of rows in Files table')
+parser.add_argument('--tasks', type=int, default=500000, help='number of rows in ConversionTasks table')
+parser.add_argument('--ops', type=int, default=1000, help='operations of every benchmark, split between processes')
+parser.add_argument('--select-ops', type=int, default=5, help='operations of benchmarks reading the whole catalog')
+parser.add_argument('--processes', type=int, default=4, help='run every benchmark with 1..N concurrent processes')
+parser.add_argument('--benchmark', action='append', choices=BENCHMARKS, help='benchmark to run, all if omitted, may be repeated')
+parser.add_argument('--work-dir', help='directory for temporary database')
+parser.add_argument('--output', help='path to JSON result, stdout if omitted')
+args = parser.parse_args()
+
+with DbBenchmark(load_config(), args.files, args.tasks, args.ops, args.select_ops, args.work_dir) as benchmark:
+    result = {'meta': benchmark.metadata()}
+    result['build_seconds'] = round(benchmark.build(), 3)
+    result['results'] = benchmark.run(args.benchmark or BENCHMARKS, range(1, args.processes + 1))
+
+if args.output:
+    with open(args.output, 'w') as output:
+        json.dump(result, output, indent=2)
+else:
+    json.dump(result, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,47 @@
+import argparse
+import os
+import sys
+from db_query.db_query import Db_query
+import json
+
+
+
+def load_config():
+    with open (os.path.join('/opt/conversion/settings', 'config.json'), 'r') as config_file:
+        config = json.load(config_file)
+        return config
+
+def summarize(files, tasks):
+    '''
+    Totals of catalog statistics by kind of file
+    '''
+    summary = {'films': {}, 'serials': {}, 'other': {}, 'tasks': dict(tasks)}
+    for is_film, is_serial, is_converted, needs_conversion, count, size in files:
+        kind = summary['films' if is_film else 'serials' if is_serial else 'other']
+        state = 'converted' if is_converted else 'left' if needs_conversion else 'not_needed'
+        totals = kind.setdefault(state, {'files': 0, 'bytes': 0})
+        totals['files'] += count
+        totals['bytes'] += size
+    return summary
+
+parser = argparse.ArgumentParser(description='Show number and size of files left to convert and results of conversions')
+parser.add_argument('--json', action='store_true', help='print statistics as JSON')
+parser.add_argument('--rebuild', action='store_true', help='recount statistics with a full scan of Files and ConversionTasks')
+args = parser.parse_args()
+
+db_file = Db_query(load_config())
+if args.rebuild:
+    db_file.rebuild_catalog_stats()
+summary = summarize(*db_file.select_catalog_stats())
+
+if args.json:
+    json.dump(summary, sys.stdout, indent=2)
+    print()
+else:
+    for kind in ['films', 'serials', 'other']:
+        for state in ['left', 'converted', 'not_needed']:
+            totals = summary[kind].get(state)
+            if totals:
+                print(f"{kind:8} {state:11} {totals['files']:>10} files {totals['bytes'] / 1024 ** 3:>12.1f} GB")
+    for status, count in summary['tasks'].items():
+        print(f"tasks    {status or '-':30} {count:>10}")
@@ -1,6 +1,5 @@
 from datetime import datetime
-import json
-from multiprocessing import Pool
+import multiprocessing
 import os
 import shutil
 import signal
@@ -8,7 +7,12 @@ import subprocess
 import tempfile
 
 from conversion.get_info import Get_Info
+from conversion.thread_budget import ThreadBudget
+from conversion.worker_pool import JobDispatcher, convert_job, init_worker
 from db_query.db_query import Db_query
+from db_query.job_queue import JobLease, job_owner
+from db_query.outbox import OutboxFlusher
+from db_query.status_writer import StatusWriter
 from custom_logging.logger import CustomLogger
 
 custom_logger = CustomLogger(log_dir="logs", max_files=30, rotation_interval=30)
@@ -57,6 +61,28 @@ class ConvertTask:
             instance of Get_Info class
         db_file : Db_query
             instance of Db_query class
+        status_writer : StatusWriter
+            instance of StatusWriter class, collects status updates of all workers
+        outbox_flusher : OutboxFlusher
+            instance of OutboxFlusher class, applies url updates to Stalker Portal while conversion runs
+        lease_seconds : float
+            seconds a claimed job belongs to worker unless its lease is renewed
+        max_attempts : int
+            number of claims after which a job whose worker died is failed
+        thread_budget : ThreadBudget
+            instance of ThreadBudget class, splits ffmpeg threads between workers
+        threads : int
+            value of ffmpeg -threads for current job
+        lease : JobLease or None
+            lease of job converted by current worker
+        claim : tuple
+            (condition, params) limiting jobs of current run, see Db_query.claim_job
+        scheduling_policy : str
+            order in which jobs are dispatched, see JobDispatcher
+        estimate_window : int
+            number of last finished jobs used to estimate length of jobs
+        estimate_default_speed : float
+            seconds of conversion per second of media while no jobs are finished
         """
         self.config = config
         self.db_file = os.path.join(config['path_to_main'], config['sqlite3'])
@@ -71,6 +97,17 @@ class ConvertTask:
         self.tmp_dir = os.path.join(config['path_to_main'], config['temp_dir'])
         self.get_info = Get_Info(config)
         self.db_file = Db_query(config)
+        self.status_writer = StatusWriter(config)
+        self.outbox_flusher = OutboxFlusher(config)
+        self.lease_seconds = config.get('job_lease_seconds', 120)
+        self.max_attempts = config.get('job_max_attempts', 3)
+        self.thread_budget = ThreadBudget(config)
+        self.threads = self.thread_budget.total
+        self.lease = None
+        self.claim = ('', ())
+        self.scheduling_policy = config.get('scheduling_policy', 'lpt')
+        self.estimate_window = config.get('estimate_window', 200)
+        self.estimate_default_speed = config.get('estimate_default_speed', 1.0)
     
     def signal_handler(self, signum, frame):
         '''
@@ -105,7 +142,7 @@ class ConvertTask:
             result of conversion
         '''
         try:
-            command = [arg.format(input_file=input_file, output_file=output_file, b_v=bitrate, b_a=self.b_a, audio_stream_index=audio_stream_index) for arg in self.ffmpeg_cpu]  #run ffmpeg command with cpu which is in config
+            command = [arg.format(input_file=input_file, output_file=output_file, b_v=bitrate, b_a=self.b_a, audio_stream_index=audio_stream_index, threads=self.threads) for arg in self.ffmpeg_cpu]  #run ffmpeg command with cpu which is in config
             subprocess.run(command, check=True)
             return True
         except subprocess.CalledProcessError as e:
@@ -114,7 +151,7 @@ class ConvertTask:
 
     def run_ffmpeg_when_error(self, input_file, output_file, bitrate):
         try:
-            command = [arg.format(input_file=input_file, output_file=output_file, b_v=bitrate, b_a=self.b_a) for arg in self.ffmpeg_when_error]  #run ffmpeg command with cpu which is in config
+            command = [arg.format(input_file=input_file, output_file=output_file, b_v=bitrate, b_a=self.b_a, threads=self.threads) for arg in self.ffmpeg_when_error]  #run ffmpeg command with cpu which is in config
             subprocess.run(command, check=True)
             return True
         except subprocess.CalledProcessError as e:
@@ -162,54 +199,38 @@ class ConvertTask:
 
         If conversion is interrupted manually, remove temporary files and update
         status of conversion in 'ConversionTasks' table.
+
+        Returns
+        -------
+        tuple
+            (state, task_id) where state is outcome of job for Db_query.finish_job: 'done' if file was converted,
+            'failed' if it was not, 'skipped' if it did not need conversion; task_id is id of conversion attempt,
+            see StatusWriter.update_status_of_conversion, None if conversion was not started
         '''
         signal.signal(signal.SIGINT, self.signal_handler)  #register signal handler
 
-        file_id, IsFilm, IsConverted, filename, nb_streams, streams = file_data
-
-        if nb_streams > 2:  #check if file contains more than 2 streams
-            streams_info = json.loads(streams)
-
-            default_rus_index = None
-            first_rus_index = None
-
-            # iterate through streams and find default=1 track
-            for stream in streams_info:
-                if stream['codec_type'] == 'audio':
-                    language = stream.get('tags', {}).get('language', '')
-                    is_default = stream.get('disposition', {}).get('default', 0)
+        file_id, IsFilm, IsConverted, filename, needs_conversion, selected_index = file_data  #audio track is selected when file is added to database
+        state, task_id = 'skipped', None
 
-                    if language == 'rus':
-                        if is_default == 1:
-                            default_rus_index = stream['index']
-                        if first_rus_index is None:
-                            first_rus_index = stream['index']
-
-            # Priority - track with default=1, if default=1 not found
-            if default_rus_index is not None:
-                selected_index = default_rus_index
-            elif first_rus_index is not None:
-                selected_index = first_rus_index
-            else:
-                selected_index = None
-            
+        if needs_conversion:  #check if file contains more than 2 streams
             if not IsConverted:
+                state = 'failed'  #until converted file is in place
 
                 os.makedirs(self.tmp_dir, exist_ok=True) # create temporary directory
 
                 success, check_result = self.check_integrity(filename) # check if file is corrupted before conversion
                 
                 if not success:  # if file is corrupted
-                    self.db_file.update_status_first_check(file_id, 'Error: check logs', datetime.now().strftime(self.data_format), datetime.now().strftime(self.data_format))
-                    self.db_file.update_isconverted_after_fail_check(file_id, True)
+                    self.status_writer.update_status_first_check(file_id, 'Error: check logs', datetime.now().strftime(self.data_format), datetime.now().strftime(self.data_format))
+                    self.status_writer.update_isconverted_after_fail_check(file_id, True)
                     logger.error(f'{filename} is corrupted. Upload a new working file to ftp.sat-dv.ru')
-                    return  # skip file
+                    return state, task_id  # skip file
 
                 with tempfile.TemporaryDirectory(dir=self.tmp_dir) as temp_dir:
                     
                     output_file = os.path.join(temp_dir, os.path.splitext(os.path.basename(filename))[0] + '.mp4')  #create output file path in temp directory
                     
-                    self.db_file.update_status_of_conversion(file_id, 'converting', datetime.now().strftime(self.data_format))  #update status of a start conversion
+                    task_id = self.status_writer.update_status_of_conversion(file_id, 'converting', datetime.now().strftime(self.data_format))  #update status of a start conversion
 
                     try:
                         if IsFilm:  #check if file is a film
@@ -225,38 +246,103 @@ class ConvertTask:
                         if success:
                             success, check_result = self.check_integrity(output_file)  #check if output file is corrupted
                             if success:
+                                if self.lease is not None and not self.lease.held():  #job was reclaimed by another worker, its result is kept
+                                    logger.error(f'{filename}: conversion job was taken over by another worker, result discarded')
+                                    self.status_writer.update_status_ending_conversion('Lease lost', datetime.now().strftime(self.data_format), 'Error: check logs', task_id)
+                                    return state, task_id
                                 final_path = os.path.join(os.path.dirname(filename), os.path.basename(output_file))  #path to move final file
                                 shutil.move(output_file, final_path)  #move file to original location
-                                self.db_file.update_status_ending_conversion('done', datetime.now().strftime(self.data_format), check_result, file_id)
+                                self.status_writer.update_status_ending_conversion('done', datetime.now().strftime(self.data_format), check_result, task_id)
                                 video_info = self.get_info.run_ffprobe(final_path)  #get video info of converted file
                                 logger.info(f'{filename} converted, new url: {final_path}')  #logging success
+                                saved = True
                                 if video_info:
                                     streams = self.get_info.streams_data(video_info)  #get streams info of converted file
-                                    self.db_file.update_files_table(final_path, True, len(streams), video_info['format']['size'], video_info['format']['bit_rate'], json.dumps(streams), file_id)  #update table 'Files' with new data
-                                    self.db_file.update_url_file(filename, final_path)  #update table 'Video_Series_Files' on Stalker Portal with new url
-                                if os.path.exists(final_path) and os.path.exists(filename):    
+                                    saved = self.status_writer.save_converted_file(filename, final_path, video_info, streams, file_id)  #update table 'Files' and queue new url for Stalker Portal, committed before original is removed
+                                if not saved:
+                                    logger.error(f'{filename} kept, converted file {final_path} could not be saved to database.')
+                                    self.status_writer.update_of_checking_integrity('Error', datetime.now().strftime(self.data_format), 'Error: check logs', task_id)  #update status of checking
+                                elif os.path.exists(final_path) and os.path.exists(filename):
                                     os.remove(filename) # remove original file
+                                    state = 'done'
+                                    self.status_writer.invalidate_probe_cache(filename)  # drop cached ffprobe output of removed file
                                     logger.info(f'{filename} removed')
                                 else:
                                     logger.error(f'{final_path} unavailable after conversion.')
-                                    self.db_file.update_of_checking_integrity('Error', datetime.now().strftime(self.data_format), 'Error: check logs', file_id)  #update status of checking
-                                    self.db_file.update_isconverted_after_fail_check(file_id, True)
+                                    self.status_writer.update_of_checking_integrity('Error', datetime.now().strftime(self.data_format), 'Error: check logs', task_id)  #update status of checking
+                                    self.status_writer.update_isconverted_after_fail_check(file_id, True)
                             else:
                                 logger.error(f'{filename} is corrupted after conversion.')
-                                self.db_file.update_of_checking_integrity('Error', datetime.now().strftime(self.data_format), 'Error: check logs', file_id)  #update status of checking
-                                self.db_file.update_isconverted_after_fail_check(file_id, True)
+                                self.status_writer.update_of_checking_integrity('Error', datetime.now().strftime(self.data_format), 'Error: check logs', task_id)  #update status of checking
+                                self.status_writer.update_isconverted_after_fail_check(file_id, True)
 
                     except Exception as e:  #catch errors
                         error_message = str(e)
                         logger.error(f'{filename}: {error_message}')  #logging errors
+        return state, task_id
+
+    def run_job(self, file_id):
+        '''
+        Claim job of file `file_id` from 'ConversionJobs' queue and convert it, called in pool worker
+
+        Parameters
+        ----------
+        file_id : int
+            id of file dispatched by JobDispatcher
 
-    def parallel_convert(self):
-        video_files = self.db_file.select_data()
-        with Pool(processes=2) as pool:
+        Returns
+        -------
+        tuple
+            (`file_id`, state the job finished in: 'done', 'failed' or 'skipped', None if job was taken by another run)
+        '''
+        owner = job_owner()
+        file_data = self.db_file.claim_job(owner, self.lease_seconds, 'AND Files.id=?', (file_id,), max_attempts=self.max_attempts)
+        if file_data is None:
+            return file_id, None
+        self.threads = self.thread_budget.acquire(self.db_file.count_queued_jobs(self.thread_budget.workers, *self.claim))
+        with JobLease(self.db_file, file_id, owner, self.lease_seconds) as self.lease:
+            state, task_id = 'failed', None
             try:
-                pool.map(self.convert_files, video_files)
-            except KeyboardInterrupt:
-                self.db_file.global_interrupted_query(datetime.now().strftime(self.data_format))
-                logger.error("Сonversion interrupted manually.")
-                pool.terminate()
-                pool.join()
+                state, task_id = self.convert_files(file_data)
+            finally:
+                self.status_writer.finish_job(file_id, owner, state, task_id)  #applied after updates of conversion, so 'done' is never seen before IsConverted
+                self.thread_budget.release(self.threads)
+        self.lease = None
+        return file_id, state
+
+    def parallel_convert(self, policy=None):
+        '''
+        Convert queued files in pool workers
+
+        Parameters
+        ----------
+        policy : str or None
+            'id', 'lpt', 'spt' or 'fair', `scheduling_policy` of config if None
+        '''
+        queued = self.db_file.enqueue_jobs()
+        logger.info(f'{queued} files queued for conversion')
+        dispatcher = JobDispatcher(self.db_file, self.thread_budget.workers, *self.claim, policy or self.scheduling_policy, self.estimate_window, self.estimate_default_speed)
+        converted = 0
+        try:
+            with self.thread_budget, self.status_writer, multiprocessing.get_context('fork').Pool(processes=self.thread_budget.workers, initializer=init_worker, initargs=(self,)) as pool:  #budget and writer are started first so that workers inherit them through fork
+                self.outbox_flusher.start()  #thread is started after workers are forked
+                try:
+                    try:
+                        for file_id, state in pool.imap_unordered(convert_job, dispatcher):  #workers get only ids of jobs, next job is dispatched when one finishes
+                            dispatcher.finished(state)
+                            if state == 'done':
+                                converted += 1
+                                logger.info(f'Job {file_id} converted, {converted} files converted')
+                            elif state is not None:
+                                logger.info(f'Job {file_id} finished as {state}')
+                    finally:
+                        dispatcher.stop()  #on any exit, task handler of pool must leave the dispatcher before the pool is terminated
+                except KeyboardInterrupt:
+                    pool.terminate()
+                    pool.join()
+                    self.status_writer.stop()  #commit updates of terminated workers before marking their tasks
+                    self.db_file.global_interrupted_query(datetime.now().strftime(self.data_format))
+                    logger.error("Сonversion interrupted manually.")
+        finally:
+            self.outbox_flusher.stop()  #last flush after status writer committed all updates
+        dispatcher.report()
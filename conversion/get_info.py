@@ -1,3 +1,6 @@
+import abc
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import fnmatch
 import json
 import os
 import subprocess
@@ -5,9 +8,214 @@ import subprocess
 from db_query.db_query import Db_query
 from custom_logging.logger import CustomLogger
 
+try:
+    import av  # optional, enables in-process probing through libav
+except ImportError:
+    av = None
+
 custom_logger = CustomLogger(log_dir="logs", max_files=30, rotation_interval=30)
 logger = custom_logger.get_logger()
 
+# (container, ((offset, bytes), ...)) - file is media if all bytes of any signature match
+MEDIA_SIGNATURES = (
+    ('Matroska/WebM', ((0, b'\x1a\x45\xdf\xa3'),)),
+    ('MP4', ((4, b'ftyp'),)),
+    ('QuickTime', ((4, b'moov'),)),
+    ('QuickTime', ((4, b'mdat'),)),
+    ('QuickTime', ((4, b'wide'),)),
+    ('QuickTime', ((4, b'free'),)),
+    ('AVI', ((0, b'RIFF'), (8, b'AVI '))),
+    ('MPEG-TS', ((0, b'\x47'), (188, b'\x47'), (376, b'\x47'))),
+    ('M2TS', ((4, b'\x47'), (196, b'\x47'), (388, b'\x47'))),
+    ('MPEG-PS', ((0, b'\x00\x00\x01\xba'),)),
+    ('FLV', ((0, b'FLV\x01'),)),
+    ('ASF/WMV', ((0, b'\x30\x26\xb2\x75\x8e\x66\xcf\x11'),)),
+    ('Ogg', ((0, b'OggS'),)),
+)
+SNIFF_SIZE = 392
+
+def to_number(value, number_type=int):
+    """Convert ffprobe value such as '1024' or 'N/A' to number or None"""
+    try:
+        return number_type(value)
+    except (TypeError, ValueError):
+        return None
+
+class StreamRecord:
+    """Stream of a media file with only the fields used by conversion"""
+    __slots__ = ('index', 'codec_type', 'codec_name', 'is_default', 'language', 'title', 'duration')
+
+    def __init__(self, index, codec_type, codec_name, is_default, language, title, duration):
+        self.index = index
+        self.codec_type = codec_type
+        self.codec_name = codec_name
+        self.is_default = is_default
+        self.language = language
+        self.title = title
+        self.duration = duration
+
+class ProbeRecord:
+    """ffprobe output of a media file with only the fields used by conversion"""
+    __slots__ = ('filename', 'nb_streams', 'size', 'bit_rate', 'duration', 'streams')
+
+    def __init__(self, filename, nb_streams, size, bit_rate, duration, streams):
+        self.filename = filename
+        self.nb_streams = nb_streams
+        self.size = size
+        self.bit_rate = bit_rate
+        self.duration = duration
+        self.streams = streams
+
+    @classmethod
+    def from_ffprobe(cls, data):
+        """
+        Create record from json output of ffprobe, either full or lean profile
+
+        Parameters
+        ----------
+        data : dict
+            output of ffprobe command
+
+        Returns
+        -------
+        ProbeRecord
+        """
+        file_format = data.get('format', {})
+        streams = tuple(
+            StreamRecord(
+                stream['index'],
+                stream.get('codec_type'),
+                stream.get('codec_name'),
+                stream.get('disposition', {}).get('default', 0),
+                stream.get('tags', {}).get('language'),
+                stream.get('tags', {}).get('title'),
+                to_number(stream.get('duration'), float),
+            )
+            for stream in data.get('streams', [])
+        )
+        return cls(
+            file_format.get('filename'),
+            to_number(file_format.get('nb_streams')),
+            to_number(file_format.get('size')),
+            to_number(file_format.get('bit_rate')),
+            to_number(file_format.get('duration'), float),
+            streams,
+        )
+
+    def to_ffprobe(self):
+        """
+        Convert record back to ffprobe json layout, used to store it in 'ProbeCache' table
+
+        Returns
+        -------
+        dict
+        """
+        return {
+            'format': {
+                'filename': self.filename,
+                'nb_streams': self.nb_streams,
+                'size': self.size,
+                'bit_rate': self.bit_rate,
+                'duration': self.duration,
+            },
+            'streams': [
+                {
+                    'index': stream.index,
+                    'codec_type': stream.codec_type,
+                    'codec_name': stream.codec_name,
+                    'duration': stream.duration,
+                    'disposition': {'default': stream.is_default},
+                    'tags': {'language': stream.language, 'title': stream.title},
+                }
+                for stream in self.streams
+            ],
+        }
+
+class ProbeBackend(abc.ABC):
+    """Interface of probe backends, `probe` returns ProbeRecord or None if file can not be probed"""
+    @abc.abstractmethod
+    def probe(self, file_path):
+        pass
+
+class SubprocessProbeBackend(ProbeBackend):
+    """Probe backend running ffprobe command for every file"""
+    def __init__(self, ffprobe_command):
+        self.ffprobe_command = ffprobe_command
+
+    def probe(self, file_path):
+        """
+        Run ffprobe command on given file and parse its output.
+
+        Parameters
+        ----------
+        file_path : str
+            path to file
+
+        Returns
+        -------
+        ProbeRecord or None
+            parsed output of ffprobe command or None if an error occurs
+        """
+        command = [arg.format(file_path=file_path) for arg in self.ffprobe_command]
+        result = subprocess.run(command, capture_output=True, text=True)
+        
+        if result.returncode != 0:
+            logger.error(f"ERROR - ffprobe failed with file {file_path}: {result.stderr}")
+            print(result.stderr)
+            return None
+        if not result.stdout.strip():
+            logger.error(f"ERROR - ffprobe failed with file {file_path}: Empty output")
+            return None
+        try:
+            return ProbeRecord.from_ffprobe(json.loads(result.stdout))
+        except json.JSONDecodeError:
+            logger.error(f"ERROR - decoding JSON failed with file {file_path}: {result.stdout}")
+            return None
+
+class LibavProbeBackend(ProbeBackend):
+    """Probe backend reading container headers in process through PyAV, without spawning ffprobe"""
+    AV_DISPOSITION_DEFAULT = 0x0001
+
+    def probe(self, file_path):
+        """
+        Open file with libav and read its format and streams.
+
+        Parameters
+        ----------
+        file_path : str
+            path to file
+
+        Returns
+        -------
+        ProbeRecord or None
+            same fields as ffprobe output or None if an error occurs
+        """
+        try:
+            with av.open(file_path) as container:
+                streams = tuple(
+                    StreamRecord(
+                        stream.index,
+                        stream.type,
+                        getattr(stream.codec_context, 'name', None),
+                        1 if int(getattr(stream, 'disposition', 0)) & self.AV_DISPOSITION_DEFAULT else 0,
+                        stream.metadata.get('language'),
+                        stream.metadata.get('title'),
+                        float(stream.duration * stream.time_base) if stream.duration and stream.time_base else None,
+                    )
+                    for stream in container.streams
+                )
+                return ProbeRecord(
+                    file_path,
+                    len(streams),
+                    os.path.getsize(file_path),
+                    container.bit_rate or None,
+                    container.duration / av.time_base if container.duration else None,
+                    streams,
+                )
+        except Exception as e:
+            logger.error(f"ERROR - libav failed with file {file_path}: {e}")
+            return None
+
 class Get_Info:
     def __init__(self, config):
         """
@@ -25,60 +233,195 @@ class Get_Info:
         db_file : str
             path to database file
         ffprobe_command : str
-            command to run ffprobe
+            command to run ffprobe, 'ffprobe_lean_command' from config if 'probe_profile'
+            is 'lean', otherwise 'ffprobe_command'
+        probe_backend : ProbeBackend
+            SubprocessProbeBackend by default, LibavProbeBackend only if 'probe_backend' is 'libav'
+            or 'auto' and PyAV is installed
+        probe_cache_max_entries : int
+            maximum number of ffprobe results kept in 'ProbeCache' table
+        probe_workers : int
+            number of ffprobe processes run at the same time
+        ingest_batch_size : int
+            number of files saved to database in one transaction
+        sniff_media : bool
+            check first bytes of files against MEDIA_SIGNATURES before running ffprobe
+        skipped_files : int
+            number of files skipped as not media
+        saved_files : int
+            number of files inserted into 'Files' table
+        existing_files : int
+            number of probed files which were already in 'Files' table
+        path_rules : list of dict
+            rules {"pattern": glob relative to scanned directory, "type": "film" or "serial"}
+            used to classify files, first matching rule wins
+        film_max_depth : int
+            files nested in at most this many directories are films if no rule matches,
+            deeper files are serials
         Db_query : Db_query
             instance of Db_query class
         """
         self.config = config
         self.db_file = os.path.join(config['path_to_main'], config['sqlite3'])
-        self.ffprobe_command = config['ffprobe_command']
+        if config.get('probe_profile', 'lean') == 'lean' and 'ffprobe_lean_command' in config:
+            self.ffprobe_command = config['ffprobe_lean_command']
+        else:
+            self.ffprobe_command = config['ffprobe_command']
+        self.probe_backend = self.create_probe_backend(config.get('probe_backend', 'subprocess'))
+        self.probe_cache_max_entries = config.get('probe_cache_max_entries', 500000)
+        self.probe_workers = max(1, config.get('probe_workers', os.cpu_count() or 1))
+        self.ingest_batch_size = max(1, config.get('ingest_batch_size', 500))
+        self.sniff_media = config.get('sniff_media', True)
+        self.skipped_files = 0
+        self.saved_files = 0
+        self.existing_files = 0
+        self.path_rules = config.get('path_rules', [])
+        self.film_max_depth = config.get('film_max_depth', 1)
         self.Db_query = Db_query(config)
 
-    def get_all_files_info(self, directory):
+    def get_all_files_info(self, directory, full=False):
         """
         Get all files info in directory and subdirectories
 
+        Files are classified as films or serials by `classify_file` while the tree
+        is traversed, so every directory is listed only once.
+
+        Directory mtimes are kept in 'DirSnapshots' table. Unless `full` is set,
+        directories whose mtime has not changed since the last scan are not listed,
+        only their known subdirectories are checked. Files of such directories that
+        could not be probed are kept in 'ProbeFailures' table and probed again
+        once their size or mtime changes.
+
         Parameters
         ----------
         directory : str
             path to directory
+        full : bool
+            list every directory regardless of saved snapshots
 
         Returns
         -------
-        video_files : list of str
-            list of files
-        subdirectories : list of str
-            list of subdirectories
+        int
+            number of files found
         """
-        
-        video_files = []
-        subdirectories = []
-        for root, dirs, files in os.walk(directory):
-            if os.path.dirname(root) == directory:
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    video_files.append(file_path)
-                    video_info = self.run_ffprobe(file_path)
-                    if video_info:
-                        streams = self.streams_data(video_info)
-                        self.Db_query.save_file_data(video_info, streams, is_film=True, is_serial=False)
-                    else:
-                        logger.warning(f"No video info for file: {file_path}")
-                                
-                for subdir in dirs:
-                    subdir_path = os.path.join(root, subdir)
-                    if os.path.isdir(subdir_path):
-                        for sub_root, sub_dirs, sub_files in os.walk(subdir_path):
-                            for sub_file in sub_files:
-                                sub_file_path = os.path.join(sub_root, sub_file)
-                                video_info = self.run_ffprobe(sub_file_path)
-                                if video_info:
-                                    streams = self.streams_data(video_info)
-                                    self.Db_query.save_file_data(video_info, streams, is_film=False, is_serial=True)
-                                else:
-                                    logger.warning(f"No video info for file: {sub_file_path}")
-
-        return video_files, subdirectories
+        directory = os.path.normpath(directory)
+        previous = {}
+        for path, parent, mtime_ns in self.Db_query.select_dir_snapshots(directory):
+            previous.setdefault(path, [None, []])[0] = mtime_ns
+            if parent is not None:
+                previous.setdefault(parent, [None, []])[1].append(path)
+
+        changed_dirs = {}
+        files_count = 0
+
+        def walk():
+            nonlocal files_count
+            for file_path, depth in self.iter_files(directory, {} if full else previous, changed_dirs):
+                files_count += 1
+                yield (file_path, *self.classify_file(directory, file_path, depth))
+            missing = []
+            for file_path in self.Db_query.select_probe_failures(directory):
+                if not os.path.isfile(file_path):
+                    missing.append(file_path)
+                    continue
+                if os.path.dirname(file_path) in changed_dirs:
+                    continue  # listed above
+                depth = os.path.relpath(file_path, directory).count(os.sep)
+                yield (file_path, *self.classify_file(directory, file_path, depth))  # unchanged files are skipped by run_ffprobe
+            self.Db_query.delete_probe_failures(missing)
+
+        self.save_files_info(walk())
+
+        snapshots = []
+        removed_dirs = []
+        for path, (mtime_ns, subdirs) in changed_dirs.items():
+            snapshots.append((path, None if path == directory else os.path.dirname(path), mtime_ns))
+            if path in previous:
+                removed_dirs.extend(set(previous[path][1]) - set(subdirs))
+        self.Db_query.save_dir_snapshots(snapshots, removed_dirs)
+
+        self.Db_query.evict_probe_cache(self.probe_cache_max_entries)
+        return files_count
+
+    def iter_files(self, directory, snapshots=None, changed_dirs=None):
+        """
+        Lazily walk directory tree with os.scandir.
+
+        Symlinked directories are not followed.
+
+        Parameters
+        ----------
+        directory : str
+            path to directory
+        snapshots : dict, optional
+            path -> [mtime_ns, list of subdirectories] from previous scan. Directories
+            with the same mtime are not listed, only their subdirectories are visited
+        changed_dirs : dict, optional
+            filled with path -> (mtime_ns, list of subdirectories) for every listed
+            directory, used only together with `snapshots`
+
+        Yields
+        ------
+        tuple
+            (file_path, depth) where depth is number of directories between
+            `directory` and the file
+        """
+        stack = [(directory, 0)]
+        while stack:
+            path, depth = stack.pop()
+            if snapshots is not None:
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except OSError as e:
+                    logger.error(f"ERROR - cannot stat directory {path}: {e}")
+                    continue
+                snapshot = snapshots.get(path)
+                if snapshot and snapshot[0] == mtime_ns:
+                    stack.extend((subdir, depth + 1) for subdir in snapshot[1])
+                    continue
+
+            subdirs = []
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.is_file():
+                            yield entry.path, depth
+            except OSError as e:
+                logger.error(f"ERROR - cannot list directory {path}: {e}")
+                continue
+
+            stack.extend((subdir, depth + 1) for subdir in subdirs)
+            if snapshots is not None and changed_dirs is not None:
+                changed_dirs[path] = (mtime_ns, subdirs)
+
+    def classify_file(self, directory, file_path, depth):
+        """
+        Classify file as film or serial using 'path_rules' and 'film_max_depth' from config
+
+        Parameters
+        ----------
+        directory : str
+            path to scanned directory
+        file_path : str
+            path to file
+        depth : int
+            number of directories between `directory` and the file
+
+        Returns
+        -------
+        tuple
+            (is_film, is_serial)
+        """
+        if self.path_rules:
+            relative_path = os.path.relpath(file_path, directory)
+            for rule in self.path_rules:
+                if fnmatch.fnmatch(relative_path, rule['pattern']):
+                    return rule['type'] == 'film', rule['type'] == 'serial'
+
+        is_film = depth <= self.film_max_depth
+        return is_film, not is_film
     
     def get_single_file_info(self, file_path, is_film, is_serial):
         """
@@ -115,22 +458,121 @@ class Get_Info:
         """
         
         video_files = []
-        for root, dirs, files in os.walk(directory):
-            for file in files:
-                file_path = os.path.join(root, file)
+
+        def walk():
+            for file_path, depth in self.iter_files(directory):
                 video_files.append(file_path)
-                video_info = self.run_ffprobe(file_path)
+                yield file_path, is_film, is_serial
+
+        self.save_files_info(walk())
+        self.Db_query.evict_probe_cache(self.probe_cache_max_entries)
+        return video_files
+                                
+    def probe_files(self, files):
+        """
+        Run ffprobe on files concurrently in a bounded pool of threads.
+
+        At most 2 * probe_workers files are in flight, so `files` may be a lazy
+        iterable of any length.
+
+        Parameters
+        ----------
+        files : iterable of tuple
+            (file_path, is_film, is_serial) for every file
+
+        Files which are not media according to `is_media_file` are not probed,
+        they are counted in `skipped_files` and not yielded.
+
+        Yields
+        ------
+        tuple
+            (file_path, is_film, is_serial, video_info) in order of completion
+        """
+        def probe(file_path, is_film, is_serial):
+            if self.sniff_media and not self.is_media_file(file_path):
+                return None
+            return file_path, is_film, is_serial, self.run_ffprobe(file_path)
+
+        def results(done):
+            for future in done:
+                result = future.result()
+                if result is None:
+                    self.skipped_files += 1
+                else:
+                    yield result
+
+        with ThreadPoolExecutor(max_workers=self.probe_workers) as executor:
+            pending = set()
+            for file_path, is_film, is_serial in files:
+                pending.add(executor.submit(probe, file_path, is_film, is_serial))
+                if len(pending) >= 2 * self.probe_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from results(done)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from results(done)
+
+    def is_media_file(self, file_path):
+        """
+        Check if file starts with a known container signature from MEDIA_SIGNATURES.
+
+        Parameters
+        ----------
+        file_path : str
+            path to file
+
+        Returns
+        -------
+        bool
+            True if file looks like media, False otherwise or if file can not be read
+        """
+        try:
+            with open(file_path, 'rb') as file:
+                header = file.read(SNIFF_SIZE)
+        except OSError as e:
+            logger.error(f"ERROR - cannot read file {file_path}: {e}")
+            return False
+
+        for _, signature in MEDIA_SIGNATURES:
+            if all(header[offset:offset + len(magic)] == magic for offset, magic in signature):
+                return True
+        return False
+
+    def save_files_info(self, files):
+        """
+        Probe files concurrently and save their info to database.
+
+        Probing runs in a pool of threads, while inserts into 'Files' table are made
+        from the calling thread only, `ingest_batch_size` files per transaction.
+
+        Parameters
+        ----------
+        files : iterable of tuple
+            (file_path, is_film, is_serial) for every file
+        """
+        skipped_files = self.skipped_files
+
+        def probed():
+            for file_path, is_film, is_serial, video_info in self.probe_files(files):
                 if video_info:
-                    streams = self.streams_data(video_info)
-                    self.Db_query.save_file_data(video_info, streams, is_film=is_film, is_serial=is_serial)
+                    yield video_info, self.streams_data(video_info), is_film, is_serial
                 else:
                     logger.warning(f"No video info for file: {file_path}")
 
-        return video_files
-                                
+        inserted, existing = self.Db_query.save_files_data(probed(), self.ingest_batch_size)
+        self.saved_files += inserted
+        self.existing_files += existing
+        logger.info(f"Saved {inserted} new files, {existing} files already in database, "
+                    f"skipped {self.skipped_files - skipped_files} files which are not media")
+
     def run_ffprobe(self, file_path):
         """
-        Run ffprobe command on given file and return its output as a dict.
+        Get ffprobe output for given file as a ProbeRecord.
+
+        The result is taken from 'ProbeCache' table if the path, size, mtime and inode
+        of the file match a cached entry, otherwise file is probed with `probe_backend`
+        and the result is cached. A failed probe is recorded in 'ProbeFailures' table
+        and the file is not probed again until its size or mtime changes.
 
         Parameters
         ----------
@@ -139,32 +581,56 @@ class Get_Info:
 
         Returns
         -------
-        dict or None
-            json output of ffprobe command or None if an error occurs
+        ProbeRecord or None
+            parsed output of ffprobe command or None if an error occurs
         """
-        command = [arg.format(file_path=file_path) for arg in self.ffprobe_command]
-        result = subprocess.run(command, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            try:
-                return json.loads(result.stdout)
-            except json.JSONDecodeError:
-                logger.error(f"ERROR - decoding JSON failed with file {file_path}: {result.stdout}")
-                return None
-        elif not json.loads(result.stdout):
-            logger.error(f"ERROR - ffprobe failed with file {file_path}: Empty output")
-        else:
-            logger.error(f"ERROR - ffprobe failed with file {file_path}: {result.stderr}")
-            print(result.stderr)
+        try:
+            stat = os.stat(file_path)
+        except OSError as e:
+            logger.error(f"ERROR - cannot stat file {file_path}: {e}")
+            return None
+
+        cached = self.Db_query.get_cached_probe(file_path, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        if cached is not None:
+            return ProbeRecord.from_ffprobe(cached)
+
+        if self.Db_query.probe_failed(file_path, stat.st_size, stat.st_mtime_ns):
+            return None
+
+        video_info = self.probe_backend.probe(file_path)
+        if video_info is None:
+            self.Db_query.save_probe_failure(file_path, stat.st_size, stat.st_mtime_ns)
             return None
+        self.Db_query.save_cached_probe(file_path, stat.st_size, stat.st_mtime_ns, stat.st_ino, video_info.to_ffprobe())
+        return video_info
+
+    def create_probe_backend(self, name):
+        """
+        Create probe backend by name
+
+        Parameters
+        ----------
+        name : str
+            'subprocess', 'libav' or 'auto', libav is used only when asked for and PyAV is installed
+
+        Returns
+        -------
+        ProbeBackend
+        """
+        if name in ('auto', 'libav'):
+            if av is not None:
+                return LibavProbeBackend()
+            if name == 'libav':
+                logger.warning("PyAV is not installed, probing with ffprobe subprocess")
+        return SubprocessProbeBackend(self.ffprobe_command)
 
     def streams_data(self, data):
         """
-        Transform a list of streams from ffprobe output into a simplified list of dicts.
+        Transform streams of probed file into a simplified list of dicts.
 
         Parameters
         ----------
-        data : dict
+        data : ProbeRecord
             output of ffprobe command
 
         Returns
@@ -173,18 +639,18 @@ class Get_Info:
             list of streams with simplified keys
         """
         transformed_streams = []
-        for stream in data.get('streams', []):
+        for stream in data.streams:
             transformed_stream = {
-                'index': stream['index'],
-                'codec_type': stream['codec_type'],
+                'index': stream.index,
+                'codec_type': stream.codec_type,
                 'disposition': {
-                    'default': stream['disposition']['default']
+                    'default': stream.is_default
                 }
             }
-            if 'tags' in stream:
+            if stream.language is not None or stream.title is not None:
                 transformed_stream['tags'] = {
-                    'language': stream['tags'].get('language'),
-                    'title': stream['tags'].get('title')
+                    'language': stream.language,
+                    'title': stream.title
                 }
             transformed_streams.append(transformed_stream)
         
@@ -0,0 +1,363 @@
+import asyncio
+from datetime import datetime
+import os
+import shutil
+import tempfile
+
+from conversion.get_info import Get_Info
+from conversion.thread_budget import ThreadBudget
+from conversion.worker_pool import JobDispatcher
+from db_query.db_query import Db_query
+from db_query.job_queue import JobLease, job_owner
+from db_query.outbox import OutboxFlusher
+from db_query.status_writer import StatusWriter
+from custom_logging.logger import CustomLogger
+
+custom_logger = CustomLogger(log_dir="logs", max_files=30, rotation_interval=30)
+logger = custom_logger.get_logger()
+
+class PipelineJob:
+    '''State of one file passing through stages of ConversionPipeline'''
+    def __init__(self, file_data, lease):
+        """
+        Initialize class variables
+
+        Parameters
+        ----------
+        file_data : tuple
+            id, IsFilm, IsConverted, filename, needs_conversion, audio_index of file, as returned by Db_query.claim_job
+        lease : JobLease
+            started lease of claimed job
+        """
+        self.file_id, self.is_film, self.is_converted, self.filename, self.needs_conversion, self.selected_index = file_data
+        self.lease = lease
+        self.temp_dir = None
+        self.output_file = None
+        self.task_id = None
+        self.state = 'failed'  #outcome of job for Db_query.finish_job, 'done' once converted file is in place
+
+class ConversionPipeline:
+    '''Class for converting queued files in asyncio stages: pre-check, encode, verify and publish'''
+    def __init__(self, config):
+        """
+        Initialize class variables
+
+        Parameters
+        ----------
+        config : dict
+            config dictionary
+
+        Attributes
+        ----------
+        data_format : str
+            format of date and time
+        ffmpeg_cpu : list of str
+            list of arguments for ffmpeg command with cpu
+        ffmpeg_when_error : list of str
+            list of arguments for ffmpeg command when audio track is not selected
+        ffmpeg_check_command : list of str
+            list of arguments for ffmpeg command to check integrity of file
+        tmp_dir : str
+            directory for temporary output files
+        owner : str
+            name of this process in 'ConversionJobs' table
+        thread_budget : ThreadBudget
+            instance of ThreadBudget class, its workers are the encode slots
+        check_workers : int
+            number of integrity checks running at once, before and after encoding
+        publish_workers : int
+            number of converted files moved and recorded at once
+        queue_size : int
+            number of jobs waiting between two stages
+        claim : tuple
+            (condition, params) limiting jobs of current run, see Db_query.claim_job
+        dispatcher : JobDispatcher or None
+            picks jobs of current run by scheduling policy
+        converted : int
+            number of files converted by current run
+        checking : int
+            number of jobs in pre-check
+        """
+        self.config = config
+        self.data_format = config['data_format']
+        self.ffmpeg_cpu = config['ffmpeg_cpu']
+        self.ffmpeg_when_error = config['ffmpeg_when_error']
+        self.ffmpeg_check_command = config['ffmpeg_check_command']
+        self.bitrate_video_film = config['bitrate_video_film']
+        self.bitrate_video_serials = config['bitrate_video_serial']
+        self.b_a = config['bitrate_audio']
+        self.tmp_dir = os.path.join(config['path_to_main'], config['temp_dir'])
+        self.get_info = Get_Info(config)
+        self.db_file = Db_query(config)
+        self.status_writer = StatusWriter(config)
+        self.outbox_flusher = OutboxFlusher(config)
+        self.owner = job_owner()
+        self.lease_seconds = config.get('job_lease_seconds', 120)
+        self.max_attempts = config.get('job_max_attempts', 3)
+        self.thread_budget = ThreadBudget(config)
+        self.check_workers = config.get('pipeline_check_workers', 2)
+        self.publish_workers = config.get('pipeline_publish_workers', 1)
+        self.queue_size = config.get('pipeline_queue_size', 2)
+        self.scheduling_policy = config.get('scheduling_policy', 'lpt')
+        self.estimate_window = config.get('estimate_window', 200)
+        self.estimate_default_speed = config.get('estimate_default_speed', 1.0)
+        self.claim = ('', ())
+        self.dispatcher = None
+        self.converted = 0
+        self.checking = 0
+        self.to_check = None
+        self.to_encode = None
+
+    def convert(self, directory=None, policy=None):
+        '''
+        Convert queued files, of `directory` only if it is given
+
+        Parameters
+        ----------
+        directory : str or None
+            path to directory
+        policy : str or None
+            'id', 'lpt', 'spt' or 'fair', `scheduling_policy` of config if None
+        '''
+        if directory is None:
+            queued = self.db_file.enqueue_jobs()
+        else:
+            queued = self.db_file.enqueue_jobs('AND filename LIKE ?', (directory + '%',))
+            self.claim = ('AND Files.filename LIKE ?', (directory + '%',))
+        logger.info(f'{queued} files queued for conversion')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.dispatcher = JobDispatcher(self.db_file, self.thread_budget.workers, *self.claim, policy or self.scheduling_policy,
+                                        self.estimate_window, self.estimate_default_speed)
+        self.dispatcher.update_speeds()
+        try:
+            with self.thread_budget, self.status_writer:
+                self.outbox_flusher.start()
+                try:
+                    asyncio.run(self.run_stages())
+                except KeyboardInterrupt:
+                    self.status_writer.stop()  #commit updates of cancelled jobs before marking their tasks
+                    self.db_file.global_interrupted_query(datetime.now().strftime(self.data_format))
+                    logger.error("Pipeline conversion interrupted.")
+        finally:
+            self.outbox_flusher.stop()  #last flush after status writer committed all updates
+        self.dispatcher.report()
+
+    async def run_stages(self):
+        '''
+        Run stages connected by bounded queues. Every stage has its own number of workers,
+        so encode slots only encode while checks and bookkeeping of other files overlap with them.
+        A stage is stopped once everything before it is done and its queue is empty.
+        '''
+        to_check = self.to_check = asyncio.Queue(self.queue_size)
+        to_encode = self.to_encode = asyncio.Queue(self.queue_size)
+        to_verify = asyncio.Queue(self.queue_size)
+        to_publish = asyncio.Queue(self.queue_size)
+        stages = [
+            (to_check, self.pre_check, to_encode, self.check_workers),
+            (to_encode, self.encode, to_verify, self.thread_budget.workers),
+            (to_verify, self.verify, to_publish, self.check_workers),
+            (to_publish, self.publish, None, self.publish_workers),
+        ]
+        workers = [[asyncio.create_task(self.stage_worker(inbox, handler, outbox)) for _ in range(count)]
+                   for inbox, handler, outbox, count in stages]
+        try:
+            await self.produce(to_check)
+            for (inbox, _, _, _), stage_workers in zip(stages, workers):
+                await inbox.join()
+                for worker in stage_workers:
+                    worker.cancel()
+        finally:
+            for stage_workers in workers:
+                for worker in stage_workers:
+                    worker.cancel()
+            await asyncio.gather(*(worker for stage_workers in workers for worker in stage_workers), return_exceptions=True)
+            for inbox, _, _, _ in stages:  #jobs left waiting between stages when run is interrupted
+                while not inbox.empty():
+                    self.release_job(inbox.get_nowait())
+
+    async def produce(self, queue):
+        '''
+        Claim jobs picked by dispatcher and put them to first stage, waits while the stage is full
+        '''
+        while True:
+            file_id = await asyncio.to_thread(self.dispatcher.take_job)
+            if file_id is None:
+                return
+            claim = asyncio.ensure_future(asyncio.to_thread(self.db_file.claim_job, self.owner, self.lease_seconds, 'AND Files.id=?', (file_id,), self.max_attempts))
+            try:
+                file_data = await asyncio.shield(claim)
+            except asyncio.CancelledError:
+                file_data = await claim  #claim completes in its thread anyway
+                if file_data is not None:
+                    self.release_job(PipelineJob(file_data, JobLease(self.db_file, file_id, self.owner, self.lease_seconds)))
+                raise
+            if file_data is None:  #taken by another run
+                continue
+            job = PipelineJob(file_data, JobLease(self.db_file, file_id, self.owner, self.lease_seconds))
+            if not job.needs_conversion or job.is_converted:  #converted or changed since it was queued
+                job.state = 'skipped'
+                await asyncio.to_thread(self.finish_job, job)
+                continue
+            job.lease.start()
+            try:
+                await queue.put(job)
+            except asyncio.CancelledError:
+                self.release_job(job)
+                raise
+
+    async def stage_worker(self, inbox, handler, outbox):
+        '''
+        Pass jobs of `inbox` through `handler`. Jobs for which handler returns True go to `outbox`,
+        other jobs are finished here. A job held by a cancelled worker is put back to queue.
+        '''
+        while True:
+            job = await inbox.get()
+            try:
+                try:
+                    forward = await handler(job)
+                    if forward and outbox is not None:
+                        await outbox.put(job)
+                except asyncio.CancelledError:
+                    await asyncio.to_thread(self.release_job, job)
+                    raise
+                except Exception as e:
+                    logger.error(f'{job.filename}: {e}')
+                    forward = False
+                if not forward or outbox is None:
+                    await asyncio.to_thread(self.finish_job, job)
+            finally:
+                inbox.task_done()
+
+    async def run_command(self, command, capture=False):
+        '''
+        Run command in a subprocess without blocking the event loop
+
+        Returns
+        -------
+        tuple
+            (return code, stderr) where stderr is '' unless `capture` is True
+        '''
+        pipe = asyncio.subprocess.PIPE if capture else None
+        process = await asyncio.create_subprocess_exec(*command, stdout=pipe, stderr=pipe)
+        try:
+            _, stderr = await process.communicate()
+        finally:
+            if process.returncode is None:  #cancelled
+                process.kill()
+                await process.wait()
+        return process.returncode, (stderr or b'').decode(errors='replace')
+
+    async def check_integrity(self, filename):
+        '''
+        Check if file is corrupted
+
+        Returns
+        -------
+        tuple
+            (bool, str) where bool is result of check and str is error or 'No errors found'
+        '''
+        print(f"Checking file {filename} if corrupted...")
+        try:
+            _, stderr = await self.run_command([arg.format(output_file=filename) for arg in self.ffmpeg_check_command], capture=True)
+            if stderr:
+                return False, stderr
+            return True, 'No errors found'
+        except Exception as e:
+            return False, str(e)
+
+    async def pre_check(self, job):
+        self.checking += 1
+        try:
+            success, _ = await self.check_integrity(job.filename)
+        finally:
+            self.checking -= 1
+        if not success:
+            self.status_writer.update_status_first_check(job.file_id, 'Error: check logs', datetime.now().strftime(self.data_format), datetime.now().strftime(self.data_format))
+            self.status_writer.update_isconverted_after_fail_check(job.file_id, True)
+            logger.error(f'{job.filename} is corrupted. Upload a new working file to ftp.sat-dv.ru')
+            return False
+        return True
+
+    async def encode(self, job):
+        job.temp_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        job.output_file = os.path.join(job.temp_dir, os.path.splitext(os.path.basename(job.filename))[0] + '.mp4')
+        job.task_id = self.status_writer.update_status_of_conversion(job.file_id, 'converting', datetime.now().strftime(self.data_format))
+        bitrate = self.bitrate_video_film if job.is_film else self.bitrate_video_serials
+        #jobs claimed by pipeline are 'running' in database, those before encode start next as well
+        upcoming = self.to_check.qsize() + self.checking + self.to_encode.qsize()
+        threads = self.thread_budget.acquire(upcoming + await asyncio.to_thread(self.db_file.count_queued_jobs, self.thread_budget.workers, *self.claim))
+        try:
+            if job.selected_index is not None:
+                command = [arg.format(input_file=job.filename, output_file=job.output_file, b_v=bitrate, b_a=self.b_a, audio_stream_index=job.selected_index, threads=threads) for arg in self.ffmpeg_cpu]
+            else:
+                command = [arg.format(input_file=job.filename, output_file=job.output_file, b_v=bitrate, b_a=self.b_a, threads=threads) for arg in self.ffmpeg_when_error]
+            returncode, _ = await self.run_command(command)
+        finally:
+            self.thread_budget.release(threads)
+        if returncode != 0:
+            logger.error(f"Error running ffmpeg: {command} returned {returncode}")
+            return False
+        return True
+
+    async def verify(self, job):
+        success, check_result = await self.check_integrity(job.output_file)
+        if not success:
+            logger.error(f'{job.filename} is corrupted after conversion.')
+            self.status_writer.update_of_checking_integrity('Error', datetime.now().strftime(self.data_format), 'Error: check logs', job.task_id)
+            self.status_writer.update_isconverted_after_fail_check(job.file_id, True)
+            return False
+        self.status_writer.update_status_ending_conversion('done', datetime.now().strftime(self.data_format), check_result, job.task_id)
+        return True
+
+    async def publish(self, job):
+        if not await asyncio.to_thread(job.lease.held):  #job was reclaimed by another worker
+            logger.error(f'{job.filename}: conversion job was taken over by another worker, result discarded')
+            self.status_writer.update_status_ending_conversion('Lease lost', datetime.now().strftime(self.data_format), 'Error: check logs', job.task_id)
+            return False
+        final_path = os.path.join(os.path.dirname(job.filename), os.path.basename(job.output_file))
+        await asyncio.to_thread(shutil.move, job.output_file, final_path)
+        video_info = await asyncio.to_thread(self.get_info.run_ffprobe, final_path)
+        logger.info(f'{job.filename} converted, new url: {final_path}')
+        saved = True
+        if video_info:
+            streams = self.get_info.streams_data(video_info)
+            saved = await asyncio.to_thread(self.status_writer.save_converted_file, job.filename, final_path, video_info, streams, job.file_id)  #committed before original is removed
+        if not saved:
+            logger.error(f'{job.filename} kept, converted file {final_path} could not be saved to database.')
+            self.status_writer.update_of_checking_integrity('Error', datetime.now().strftime(self.data_format), 'Error: check logs', job.task_id)
+            return False
+        if os.path.exists(final_path) and os.path.exists(job.filename):
+            await asyncio.to_thread(os.remove, job.filename)
+            self.status_writer.invalidate_probe_cache(job.filename)
+            logger.info(f'{job.filename} removed')
+            job.state = 'done'
+        else:
+            logger.error(f'{final_path} unavailable after conversion.')
+            self.status_writer.update_of_checking_integrity('Error', datetime.now().strftime(self.data_format), 'Error: check logs', job.task_id)
+            self.status_writer.update_isconverted_after_fail_check(job.file_id, True)
+            return False
+        self.converted += 1
+        logger.info(f'Job {job.file_id} finished, {self.converted} jobs done')
+        return True
+
+    def finish_job(self, job):
+        '''
+        Stop lease, remove temporary files and mark job as finished
+        '''
+        job.lease.stop()
+        if job.temp_dir is not None:
+            shutil.rmtree(job.temp_dir, ignore_errors=True)
+        self.status_writer.finish_job(job.file_id, self.owner, job.state, job.task_id)  #applied after updates of conversion
+        self.dispatcher.update_speeds()
+
+    def release_job(self, job):
+        '''
+        Put job of an interrupted run back to queue
+        '''
+        job.lease.stop()
+        if job.temp_dir is not None:
+            shutil.rmtree(job.temp_dir, ignore_errors=True)
+        self.db_file.finish_job(job.file_id, self.owner, 'queued')
+
+# if __name__ == '__main__':
+#     pass
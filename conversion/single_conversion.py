@@ -1,5 +1,4 @@
 from datetime import datetime
-import json
 import os
 import shutil
 import signal
@@ -8,7 +7,10 @@ import sys
 import tempfile
 
 from conversion.get_info import Get_Info
+from conversion.thread_budget import ThreadBudget
 from db_query.db_query import Db_query
+from db_query.job_queue import JobLease, job_owner
+from db_query.outbox import OutboxFlusher
 from custom_logging.logger import CustomLogger
 
 custom_logger = CustomLogger(log_dir="logs", max_files=30, rotation_interval=30)
@@ -55,10 +57,26 @@ class ConvertTask:
             list of files to remove
         file_id : int
             id of current file
+        task_id : int
+            id of current conversion attempt in ConversionTasks table
         get_info : Get_Info
             instance of Get_Info class
         db_file : Db_query
             instance of Db_query class
+        outbox_flusher : OutboxFlusher
+            instance of OutboxFlusher class, applies url updates to Stalker Portal
+        lease_seconds : float
+            seconds a claimed job belongs to this run unless its lease is renewed
+        max_attempts : int
+            number of claims after which a job whose worker died is failed
+        owner : str
+            name of this run in 'ConversionJobs' table
+        thread_budget : ThreadBudget
+            instance of ThreadBudget class, gives all threads of the budget to the single job
+        threads : int
+            value of ffmpeg -threads for current job
+        lease : JobLease or None
+            lease of claimed job
         """
         self.config = config
         self.db_file = os.path.join(config['path_to_main'], config['sqlite3'])
@@ -73,8 +91,16 @@ class ConvertTask:
         self.tmp_dir = os.path.join(config['path_to_main'], config['temp_dir'])
         self.interrupted = False
         self.file_id = None
+        self.task_id = None
         self.get_info = Get_Info(config)
         self.db_file = Db_query(config)
+        self.outbox_flusher = OutboxFlusher(config)
+        self.lease_seconds = config.get('job_lease_seconds', 120)
+        self.max_attempts = config.get('job_max_attempts', 3)
+        self.thread_budget = ThreadBudget(config)
+        self.threads = self.thread_budget.total
+        self.owner = job_owner()
+        self.lease = None
     
     def signal_handler(self, signum, frame):
         '''
@@ -84,8 +110,12 @@ class ConvertTask:
         self.interrupted = True
         shutil.rmtree(self.tmp_dir, ignore_errors=True)
         os.mkdir(self.tmp_dir)
-        if self.file_id is not None:
-            self.db_file.interrupted_program(datetime.now().strftime(self.data_format), self.file_id)
+        if self.task_id is not None:
+            self.db_file.interrupted_program(datetime.now().strftime(self.data_format), self.task_id)
+        if self.lease is not None:
+            self.lease.stop()
+            self.db_file.finish_job(self.lease.file_id, self.owner, 'queued')  # give job back to queue
+            self.lease = None
         sys.exit(1)
 
     def run_ffmpeg(self, input_file, output_file, bitrate, audio_stream_index):
@@ -107,7 +137,7 @@ class ConvertTask:
             result of conversion
         '''
         try:
-            command = [arg.format(input_file=input_file, output_file=output_file, b_v=bitrate, b_a=self.b_a, audio_stream_index=audio_stream_index) for arg in self.ffmpeg_cpu]  #run ffmpeg command with cpu which is in config
+            command = [arg.format(input_file=input_file, output_file=output_file, b_v=bitrate, b_a=self.b_a, audio_stream_index=audio_stream_index, threads=self.threads) for arg in self.ffmpeg_cpu]  #run ffmpeg command with cpu which is in config
             subprocess.run(command, check=True)
             return True
         except subprocess.CalledProcessError as e:
@@ -116,7 +146,7 @@ class ConvertTask:
     
     def run_ffmpeg_when_error(self, input_file, output_file, bitrate):
         try:
-            command = [arg.format(input_file=input_file, output_file=output_file, b_v=bitrate, b_a=self.b_a) for arg in self.ffmpeg_when_error]  #run ffmpeg command with cpu which is in config
+            command = [arg.format(input_file=input_file, output_file=output_file, b_v=bitrate, b_a=self.b_a, threads=self.threads) for arg in self.ffmpeg_when_error]  #run ffmpeg command with cpu which is in config
             subprocess.run(command, check=True)
             return True
         except subprocess.CalledProcessError as e:
@@ -166,93 +196,110 @@ class ConvertTask:
         '''
         signal.signal(signal.SIGINT, self.signal_handler)  # register signal handler
 
-        video_files = self.db_file.select_single_data(file_data)
-
-        for file_id, IsFilm, IsConverted, filename, nb_streams, streams in video_files:  # iterate through files
-            self.file_id = file_id
-            if self.interrupted:
-                break
-
-            if nb_streams > 2:  # check if file contains more than 2 streams
-                streams_info = json.loads(streams)
+        self.db_file.enqueue_jobs('AND filename=?', (file_data,))
+        claimed = self.db_file.claim_job(self.owner, self.lease_seconds, 'AND Files.filename=?', (file_data,), max_attempts=self.max_attempts)
+        if claimed is None:
+            print(f'{file_data} does not need conversion or is being converted by another run')
+            return
+        self.lease = JobLease(self.db_file, claimed[0], self.owner, self.lease_seconds)  # job is claimed so that no other run converts the file at the same time
+        self.lease.start()
+        state = 'failed'  # outcome of job, see Db_query.finish_job
+        try:
+            state = self.convert_claimed(claimed)
+        finally:
+            if self.lease is not None:  # None if signal_handler gave the job back
+                self.lease.stop()
+                self.db_file.finish_job(claimed[0], self.owner, state)
+                self.lease = None
+        self.outbox_flusher.stop()  # Apply queued url updates, failed ones stay in outbox for flush_portal_outbox.py
 
-                default_rus_index = None
-                first_rus_index = None
+    def convert_claimed(self, claimed):
+        '''
+        Convert file of claimed job, audio track is selected when file is added to database
 
-                # iterate through streams and find default=1 track
-                for stream in streams_info:
-                    if stream['codec_type'] == 'audio':
-                        language = stream.get('tags', {}).get('language', '')
-                        is_default = stream.get('disposition', {}).get('default', 0)
+        Parameters
+        ----------
+        claimed : tuple
+            row returned by Db_query.claim_job
 
-                        if language == 'rus':
-                            if is_default == 1:
-                                default_rus_index = stream['index']
-                            if first_rus_index is None:
-                                first_rus_index = stream['index']
+        Returns
+        -------
+        str
+            outcome of job: 'done', 'failed' or 'skipped'
+        '''
+        file_id, IsFilm, IsConverted, filename, needs_conversion, selected_index = claimed
+        state = 'skipped'
+        self.file_id = file_id
+        if self.interrupted:
+            return state
 
-                # Priority - track with default=1, if default=1 not found
-                if default_rus_index is not None:
-                    selected_index = default_rus_index
-                elif first_rus_index is not None:
-                    selected_index = first_rus_index
-                else:
-                    selected_index = None
-                
-                # Check if file is corrupted before conversion
-                success, check_result = self.check_integrity(filename)
-                
-                if not success:  # if file is corrupted
-                    self.db_file.update_status_first_check(file_id, 'Error: check logs', datetime.now().strftime(self.data_format), datetime.now().strftime(self.data_format))
-                    self.db_file.update_isconverted_after_fail_check(file_id, True)
-                    logger.error(f'{filename} is corrupted. Upload a new working file to ftp.sat-dv.ru')
-                    continue  # Skip this file
+        if needs_conversion:  # check if file contains more than 2 streams
+            state = 'failed'  # until converted file is in place
+            # Check if file is corrupted before conversion
+            success, check_result = self.check_integrity(filename)
+            
+            if not success:  # if file is corrupted
+                self.db_file.update_status_first_check(file_id, 'Error: check logs', datetime.now().strftime(self.data_format), datetime.now().strftime(self.data_format))
+                self.db_file.update_isconverted_after_fail_check(file_id, True)
+                logger.error(f'{filename} is corrupted. Upload a new working file to ftp.sat-dv.ru')
+                return state  # Skip this file
 
-                if not IsConverted:
-                    os.makedirs(self.tmp_dir, exist_ok=True)  # Create temporary directory
+            if not IsConverted:
+                os.makedirs(self.tmp_dir, exist_ok=True)  # Create temporary directory
 
-                    with tempfile.TemporaryDirectory(dir=self.tmp_dir) as temp_dir:
-                        
-                        output_file = os.path.join(temp_dir, os.path.splitext(os.path.basename(filename))[0] + '.mp4')  # Create output file path in temp directory
-                        self.db_file.update_status_of_conversion(file_id, 'converting', datetime.now().strftime(self.data_format))
+                with tempfile.TemporaryDirectory(dir=self.tmp_dir) as temp_dir:
+                    
+                    output_file = os.path.join(temp_dir, os.path.splitext(os.path.basename(filename))[0] + '.mp4')  # Create output file path in temp directory
+                    task_id = self.db_file.update_status_of_conversion(file_id, 'converting', datetime.now().strftime(self.data_format))
+                    self.task_id = task_id
 
-                        try:
-                            if IsFilm:  # Check if file is a film
-                                bitrate = self.bitrate_video_film  # Set bitrate
-                            else:
-                                bitrate = self.bitrate_video_serials
-                            if selected_index is not None:    
-                                success = self.run_ffmpeg(filename, output_file, bitrate, selected_index)  #run ffmpeg
-                            else:
-                                success = self.run_ffmpeg_when_error(filename, output_file, bitrate)
-            
+                    try:
+                        if IsFilm:  # Check if file is a film
+                            bitrate = self.bitrate_video_film  # Set bitrate
+                        else:
+                            bitrate = self.bitrate_video_serials
+                        if selected_index is not None:    
+                            success = self.run_ffmpeg(filename, output_file, bitrate, selected_index)  #run ffmpeg
+                        else:
+                            success = self.run_ffmpeg_when_error(filename, output_file, bitrate)
+        
+                        if success:
+                            success, check_result = self.check_integrity(output_file)  # Check if output file is corrupted
                             if success:
-                                success, check_result = self.check_integrity(output_file)  # Check if output file is corrupted
-                                if success:
-                                    final_path = os.path.join(os.path.dirname(filename), os.path.basename(output_file))  # Path to move final file
-                                    shutil.move(output_file, final_path)  # Move file to original location
-                                    self.db_file.update_status_ending_conversion('done', datetime.now().strftime(self.data_format), check_result, file_id)
-                                    video_info = self.get_info.run_ffprobe(final_path)  # Get video info of converted file
-                                    logger.info(f'{filename} converted, new url: {final_path}')  # Log success
-                                    if video_info:
-                                        streams = self.get_info.streams_data(video_info)  # Get streams info of converted file
-                                        self.db_file.update_files_table(final_path, True, len(streams), video_info['format']['size'], video_info['format']['bit_rate'], json.dumps(streams), file_id)  # Update table 'Files' with new data
-                                        self.db_file.update_url_file(filename, final_path)  # Update table 'Video_Series_Files' on Stalker Portal with new url
-                                    if os.path.exists(final_path) and os.path.exists(filename):    
-                                        os.remove(filename) # remove original file
-                                        logger.info(f'{filename} removed')
-                                    else:
-                                        logger.error(f'{final_path} unavailable after conversion.')
-                                        self.db_file.update_of_checking_integrity('Error', datetime.now().strftime(self.data_format), 'Error: check logs', file_id)  #update status of checking
-                                        self.db_file.update_isconverted_after_fail_check(file_id, True)
+                                if not self.lease.held():  # job was reclaimed by another run, its result is kept
+                                    logger.error(f'{filename}: conversion job was taken over by another run, result discarded')
+                                    self.db_file.update_status_ending_conversion('Lease lost', datetime.now().strftime(self.data_format), 'Error: check logs', task_id)
+                                    return state
+                                final_path = os.path.join(os.path.dirname(filename), os.path.basename(output_file))  # Path to move final file
+                                shutil.move(output_file, final_path)  # Move file to original location
+                                self.db_file.update_status_ending_conversion('done', datetime.now().strftime(self.data_format), check_result, task_id)
+                                video_info = self.get_info.run_ffprobe(final_path)  # Get video info of converted file
+                                logger.info(f'{filename} converted, new url: {final_path}')  # Log success
+                                saved = True
+                                if video_info:
+                                    streams = self.get_info.streams_data(video_info)  # Get streams info of converted file
+                                    saved = self.db_file.save_converted_file(filename, final_path, video_info, streams, file_id)  # Update table 'Files' and queue new url for Stalker Portal, committed before original is removed
+                                if not saved:
+                                    logger.error(f'{filename} kept, converted file {final_path} could not be saved to database.')
+                                    self.db_file.update_of_checking_integrity('Error', datetime.now().strftime(self.data_format), 'Error: check logs', task_id)  # Update status of checking
+                                elif os.path.exists(final_path) and os.path.exists(filename):
+                                    os.remove(filename) # remove original file
+                                    state = 'done'
+                                    self.db_file.invalidate_probe_cache(filename)  # drop cached ffprobe output of removed file
+                                    logger.info(f'{filename} removed')
                                 else:
-                                    logger.error(f'{filename} is corrupted after conversion.')  # Log error
-                                    self.db_file.update_of_checking_integrity('Error', datetime.now().strftime(self.data_format), 'Error: check logs', file_id)  # Update status of checking
+                                    logger.error(f'{final_path} unavailable after conversion.')
+                                    self.db_file.update_of_checking_integrity('Error', datetime.now().strftime(self.data_format), 'Error: check logs', task_id)  #update status of checking
                                     self.db_file.update_isconverted_after_fail_check(file_id, True)
+                            else:
+                                logger.error(f'{filename} is corrupted after conversion.')  # Log error
+                                self.db_file.update_of_checking_integrity('Error', datetime.now().strftime(self.data_format), 'Error: check logs', task_id)  # Update status of checking
+                                self.db_file.update_isconverted_after_fail_check(file_id, True)
 
-                        except Exception as e:  # Catch errors
-                            error_message = str(e)
-                            logger.error(f'{filename}: {error_message}')  # Log errors
+                    except Exception as e:  # Catch errors
+                        error_message = str(e)
+                        logger.error(f'{filename}: {error_message}')  # Log errors
+        return state
 
 
 # if __name__ == '__main__':
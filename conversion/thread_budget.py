@@ -0,0 +1,101 @@
+import multiprocessing
+import os
+
+# threads in use and jobs running in all workers, inherited by pool workers through fork
+_budget_state = {'ledger': None}
+
+def available_cpus():
+    """Number of CPUs this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available outside Linux
+        return os.cpu_count() or 1
+
+class ThreadBudget:
+    '''Class for sharing a budget of ffmpeg threads between conversion workers'''
+    def __init__(self, config):
+        """
+        Initialize class variables
+
+        Parameters
+        ----------
+        config : dict
+            config dictionary
+
+        Attributes
+        ----------
+        total : int
+            threads of all running ffmpeg processes together, CPUs of process affinity if 'thread_budget' is not set
+        threads_per_job : int
+            threads of one job when all workers are busy, used to derive number of workers
+        min_threads : int
+            threads given to a job even if budget is used up
+        workers : int
+            number of conversion workers, derived from budget if 'conversion_workers' is not set
+        """
+        self.total = config.get('thread_budget') or available_cpus()
+        self.threads_per_job = config.get('threads_per_job', 4)
+        self.min_threads = config.get('min_threads_per_job', 1)
+        self.workers = config.get('conversion_workers') or max(1, self.total // self.threads_per_job)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        '''
+        Create ledger shared by workers forked afterwards
+        '''
+        _budget_state['ledger'] = multiprocessing.Array('i', [0, 0])  # threads in use, running jobs
+
+    def stop(self):
+        _budget_state['ledger'] = None
+
+    def acquire(self, queued):
+        '''
+        Take threads for a job which starts now. Free threads are split between this job and
+        the jobs idle workers will start next, so threads released by finished jobs go to new
+        jobs and the last jobs of a run get the cores their finished neighbours left.
+
+        Parameters
+        ----------
+        queued : int
+            number of jobs still waiting in queue, only values up to `workers` matter
+
+        Returns
+        -------
+        int
+            value for ffmpeg -threads
+        '''
+        ledger = _budget_state['ledger']
+        if ledger is None:  # single job
+            return self.total
+        with ledger.get_lock():
+            in_use, running = ledger[0], ledger[1]
+            starting = max(1, min(self.workers - running, queued + 1))
+            threads = max(self.min_threads, (self.total - in_use) // starting)
+            ledger[0] = in_use + threads
+            ledger[1] = running + 1
+        return threads
+
+    def release(self, threads):
+        '''
+        Give back threads of a finished job
+
+        Parameters
+        ----------
+        threads : int
+            value returned by `acquire`
+        '''
+        ledger = _budget_state['ledger']
+        if ledger is None:
+            return
+        with ledger.get_lock():
+            ledger[0] -= threads
+            ledger[1] -= 1
+
+# if __name__ == '__main__':
+#     pass
@@ -0,0 +1,258 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from conversion.get_info import Get_Info
+from custom_logging.logger import CustomLogger
+
+custom_logger = CustomLogger(log_dir="logs", max_files=30, rotation_interval=30)
+logger = custom_logger.get_logger()
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+class Watcher:
+    '''Class for adding new files to database as soon as they are uploaded'''
+    def __init__(self, config):
+        """
+        Initialize class variables
+
+        Parameters
+        ----------
+        config : dict
+            config dictionary
+
+        Attributes
+        ----------
+        config : dict
+            config dictionary
+        roots : list of str
+            directories to watch
+        debounce : float
+            seconds a file must stay unchanged before it is probed
+        poll_interval : float
+            seconds between scans when inotify is not available
+        get_info : Get_Info
+            instance of Get_Info class
+        pending : dict
+            path -> (size, mtime_ns, time of last change) of files waiting for upload to finish
+        watches : dict
+            inotify watch descriptor -> directory path
+        """
+        self.config = config
+        self.roots = [os.path.normpath(root) for root in config.get('watch_roots', [config['directory']])]
+        self.debounce = config.get('watch_debounce_seconds', 60)
+        self.poll_interval = config.get('watch_poll_interval', 30)
+        self.get_info = Get_Info(config)
+        self.pending = {}
+        self.watches = {}
+
+    def run(self):
+        '''
+        Watch roots forever, using inotify if available and polling otherwise
+        '''
+        try:
+            fd = self._inotify_init()
+        except OSError as e:
+            logger.warning(f'inotify unavailable, falling back to polling: {e}')
+            self._run_polling()
+            return
+
+        try:
+            for root in self.roots:
+                self._add_watches(fd, root)
+        except OSError as e:
+            os.close(fd)
+            logger.warning(f'Cannot watch all directories, falling back to polling: {e}')
+            self._run_polling()
+            return
+
+        self._run_inotify(fd)
+
+    def track(self, path):
+        '''
+        Mark file as changed, it is probed once it has not changed for `debounce` seconds
+
+        Parameters
+        ----------
+        path : str
+            path to file
+        '''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.pending.pop(path, None)
+            return
+        self.pending[path] = (stat.st_size, stat.st_mtime_ns, time.monotonic())
+
+    def check_pending(self):
+        '''
+        Save info of pending files which have not changed for `debounce` seconds
+        '''
+        now = time.monotonic()
+        ready = []
+        for path, (size, mtime_ns, changed_at) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path]  # file was removed or renamed
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self.pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - changed_at >= self.debounce:
+                del self.pending[path]
+                ready.append(path)
+
+        if ready:
+            self.get_info.save_files_info(self.classify(path) for path in ready)
+            logger.info(f'Watcher added {len(ready)} new files')
+
+    def classify(self, path):
+        '''
+        Classify file relative to the watched root it belongs to
+
+        Parameters
+        ----------
+        path : str
+            path to file
+
+        Returns
+        -------
+        tuple
+            (path, is_film, is_serial)
+        '''
+        root = max((root for root in self.roots if path.startswith(root + os.sep)), key=len)
+        depth = os.path.relpath(path, root).count(os.sep)
+        return (path, *self.get_info.classify_file(root, path, depth))
+
+    def _inotify_init(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self._libc = libc
+        return fd
+
+    def _add_watch(self, fd, path):
+        wd = self._libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return  # directory disappeared before watch was added
+            raise OSError(error, f'{os.strerror(error)}: {path}')
+        self.watches[wd] = path
+
+    def _add_watches(self, fd, directory, track_files=False):
+        '''
+        Watch directory and all its subdirectories. Files found in directories
+        appearing while watcher runs are tracked, as they may be moved in with content.
+        '''
+        stack = [directory]
+        while stack:
+            path = stack.pop()
+            self._add_watch(fd, path)
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif track_files and entry.is_file():
+                            self.track(entry.path)
+            except OSError as e:
+                logger.error(f'ERROR - cannot list directory {path}: {e}')
+
+    def _run_inotify(self, fd):
+        logger.info(f'Watching {self.roots} with inotify')
+        tick = max(1, min(self.debounce / 4, 10))
+        try:
+            while True:
+                readable, _, _ = select.select([fd], [], [], tick)
+                if readable:
+                    self._read_events(fd)
+                self.check_pending()
+        finally:
+            os.close(fd)
+
+    def _read_events(self, fd):
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0'))
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('inotify queue overflow, some uploads may be missed until next scan_storage.py run')
+                for root in self.roots:
+                    self._add_watches(fd, root)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._add_watches(fd, path, track_files=True)
+                    except OSError as e:
+                        logger.error(f'ERROR - cannot watch directory {path}: {e}')
+            else:
+                self.track(path)
+
+    def _run_polling(self):
+        '''
+        Scan roots every `poll_interval` seconds. Only directories with changed mtime
+        are listed, and only files changed since the previous scan are tracked.
+        '''
+        logger.info(f'Watching {self.roots} with polling every {self.poll_interval} seconds')
+        snapshots = {root: {} for root in self.roots}
+        for root in self.roots:
+            self._poll(root, snapshots[root], None)  # remember current state, existing files are left to scan_storage.py
+        last_poll = time.time_ns()
+
+        while True:
+            for _ in range(max(1, int(self.poll_interval // 5))):
+                time.sleep(min(5, self.poll_interval))
+                self.check_pending()
+            poll_started = time.time_ns()
+            for root in self.roots:
+                self._poll(root, snapshots[root], last_poll)
+            last_poll = poll_started
+
+    def _poll(self, root, snapshots, changed_since):
+        changed_dirs = {}
+        for file_path, _ in self.get_info.iter_files(root, snapshots, changed_dirs):
+            if changed_since is None:
+                continue
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            if max(stat.st_mtime_ns, stat.st_ctime_ns) >= changed_since:  # ctime covers files moved in with old mtime
+                self.track(file_path)
+        for path, (mtime_ns, subdirs) in changed_dirs.items():
+            snapshots[path] = [mtime_ns, subdirs]
+
+# if __name__ == '__main__':
+#     pass
@@ -0,0 +1,172 @@
+import threading
+
+from custom_logging.logger import CustomLogger
+
+custom_logger = CustomLogger(log_dir="logs", max_files=30, rotation_interval=30)
+logger = custom_logger.get_logger()
+
+# ConvertTask of current pool worker, set once by `init_worker` instead of being pickled with every job
+_worker_state = {'task': None}
+
+def init_worker(task):
+    '''
+    Pool initializer. Task is inherited through fork, so its Get_Info, Db_query connection
+    and status writer are built once per worker and serve all its jobs.
+    '''
+    _worker_state['task'] = task
+
+def convert_job(file_id):
+    '''
+    Convert one job in a pool worker, only ids travel between parent and workers
+
+    Returns
+    -------
+    tuple
+        (file_id, state of finished job), state is None if job was taken by another run
+    '''
+    return _worker_state['task'].run_job(file_id)
+
+class JobDispatcher:
+    '''Class for feeding ids of queued jobs to pool workers, one job for every free worker'''
+    def __init__(self, db_file, workers, condition='', params=(), policy='id', speed_window=200, default_speed=1.0):
+        """
+        Initialize class variables
+
+        Parameters
+        ----------
+        db_file : Db_query
+            instance of Db_query class
+        workers : int
+            number of pool workers, at most this many jobs are dispatched and unfinished
+        condition : str
+            additional sql condition on 'Files' table, starting with AND
+        params : tuple
+            parameters of `condition`
+        policy : str
+            order of jobs: 'id', 'lpt' longest estimated first, 'spt' shortest estimated first,
+            'fair' films and serials alternate so that both get equal estimated conversion time
+        speed_window : int
+            number of last finished jobs used to estimate speed of conversion
+        default_speed : float
+            seconds of conversion per second of media until jobs of a kind were finished
+
+        Attributes
+        ----------
+        dispatched : set of int
+            ids of files sent to workers
+        shares : dict
+            estimated seconds of dispatched films and serials, by IsFilm
+        speeds : tuple
+            (films, serials) seconds of conversion per second of media
+        """
+        if policy not in ('id', 'lpt', 'spt', 'fair'):
+            raise ValueError(f'Unknown scheduling policy {policy}')
+        self.db_file = db_file
+        self.workers = workers
+        self.condition = condition
+        self.params = params
+        self.policy = policy
+        self.speed_window = speed_window
+        self.default_speed = default_speed
+        self.dispatched = set()
+        self.shares = {True: 0.0, False: 0.0}
+        self.speeds = (default_speed, default_speed)
+        self._slots = threading.Semaphore(workers)
+        self._stop = threading.Event()
+
+    def __iter__(self):
+        # iterated by task handler thread of Pool, a job is picked only when a worker is free,
+        # so jobs queued while the run works are converted as well
+        self.update_speeds()
+        while not self._stop.is_set():
+            if not self._slots.acquire(timeout=1):
+                continue
+            file_id = self.take_job()
+            if file_id is None:
+                return
+            yield file_id
+
+    def take_job(self):
+        '''
+        Pick next job by policy and save its estimate
+
+        Returns
+        -------
+        int or None
+            id of file of picked job, None if queue is empty
+        '''
+        job = self.next_job()
+        if job is None:
+            return None
+        file_id, is_film, media_seconds, estimate = job
+        self.dispatched.add(file_id)
+        self.shares[bool(is_film)] += estimate
+        self.db_file.save_job_estimate(file_id, media_seconds, estimate)
+        return file_id
+
+    def next_job(self):
+        '''
+        Next queued job which is not dispatched yet, None if queue is empty
+
+        Returns
+        -------
+        tuple or None
+            (file_id, IsFilm, media_seconds, estimated seconds of conversion)
+        '''
+        if self.policy == 'fair':
+            for is_film in sorted(self.shares, key=self.shares.get):  # kind with less estimated time dispatched goes first
+                job = self.select_job('id', is_film)
+                if job is not None:
+                    return job
+            return None
+        return self.select_job(self.policy)
+
+    def select_job(self, order, is_film=None):
+        # dispatched jobs stay queued until a worker claims them, there are at most `workers` of them
+        for job in self.db_file.select_queued_jobs(self.workers + 1, self.condition, self.params, order, self.speeds, is_film):
+            if job[0] not in self.dispatched:
+                return job
+        return None
+
+    def update_speeds(self):
+        '''
+        Estimate speed of conversion from last finished jobs, so estimates follow real durations
+        '''
+        speeds = self.db_file.select_job_speeds(self.speed_window)
+        self.speeds = (speeds.get(True, self.default_speed), speeds.get(False, self.default_speed))
+
+    def finished(self, state=None):
+        '''
+        Free a worker slot after a job result came back
+
+        Parameters
+        ----------
+        state : str or None
+            state the job finished in, None if job was taken by another run
+        '''
+        if state == 'done':  # only converted jobs change measured speeds
+            self.update_speeds()
+        self._slots.release()
+
+    def report(self):
+        '''
+        Log error of estimates of last finished jobs
+
+        Returns
+        -------
+        tuple
+            result of Db_query.select_estimate_error
+        '''
+        jobs, error, bias = self.db_file.select_estimate_error(self.speed_window)
+        if jobs:
+            logger.info(f'Estimates of last {jobs} conversion jobs: mean error {error:.0%} of real duration, mean bias {bias:+.0%} (positive when jobs took longer than estimated)')
+        return jobs, error, bias
+
+    def stop(self):
+        '''
+        Stop dispatching, to be called before the pool is terminated
+        '''
+        self._stop.set()
+
+# if __name__ == '__main__':
+#     pass
@@ -0,0 +1,334 @@
+from contextlib import contextmanager
+from multiprocessing import Pool
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import mariadb
+
+from conversion.get_info import ProbeRecord, StreamRecord
+from db_query.db_query import Db_query
+from db_query.outbox import OutboxFlusher
+from db_query.status_writer import StatusWriter
+
+BENCHMARKS = ('save_file_data', 'select_data', 'select_directory_data', 'status_updates', 'status_updates_buffered', 'update_url_file')
+# benchmarks reading the whole catalog run `select_ops` operations instead of `ops`
+SELECT_BENCHMARKS = ('select_data', 'select_directory_data')
+FILES_PER_DIRECTORY = 100
+
+def synthetic_record(filename, index):
+    '''
+    ProbeRecord of a film with video, eng and default rus audio, as returned by ffprobe
+
+    Parameters
+    ----------
+    filename : str
+        path to file
+    index : int
+        number of file, used to vary size and bit rate
+
+    Returns
+    -------
+    ProbeRecord
+    '''
+    streams = (
+        StreamRecord(0, 'video', 'h264', 1, '', '', 5400.0),
+        StreamRecord(1, 'audio', 'ac3', 0, 'eng', '', 5400.0),
+        StreamRecord(2, 'audio', 'ac3', 1, 'rus', 'Dub', 5400.0),
+    )
+    return ProbeRecord(filename, len(streams), 1_000_000_000 + index, 4_000_000 + index % 1000, 5400.0, streams)
+
+def streams_dicts(record):
+    return [{'index': stream.index, 'codec_type': stream.codec_type, 'disposition': {'default': stream.is_default},
+             'tags': {'language': stream.language, 'title': stream.title}} for stream in record.streams]
+
+def catalog_filename(index):
+    return f'/storage/films/dir{index // FILES_PER_DIRECTORY}/film{index}.mkv'
+
+@contextmanager
+def maria_errors():
+    # OutboxFlusher handles mariadb.Error only, sqlite errors of the stand-in are raised as such
+    try:
+        yield
+    except sqlite3.Error as e:
+        raise mariadb.Error(str(e)) from e
+
+class LocalPortal:
+    '''Stand-in for maria connection pool of OutboxFlusher, video_series_files table lives in a local sqlite file'''
+    def __init__(self, path):
+        self.path = path
+
+    def get_connection(self):
+        with maria_errors():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+        return LocalPortalConnection(conn)
+
+    def close(self):
+        pass
+
+class LocalPortalConnection:
+    '''Sqlite connection used like a pooled maria connection, returned to the pool (closed) when its block ends'''
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def cursor(self):
+        return LocalPortalCursor(self.conn.cursor())
+
+    def commit(self):
+        with maria_errors():
+            self.conn.commit()
+
+    def rollback(self):
+        with maria_errors():
+            self.conn.rollback()
+
+    def ping(self):
+        with maria_errors():
+            self.conn.execute('SELECT 1')
+
+    def close(self):
+        self.conn.close()
+
+class LocalPortalCursor:
+    '''Sqlite cursor raising mariadb.Error'''
+    def __init__(self, cur):
+        self.cur = cur
+
+    def execute(self, query, params=()):
+        with maria_errors():
+            self.cur.execute(query, params)
+
+    def executemany(self, query, rows):
+        with maria_errors():
+            self.cur.executemany(query, rows)
+
+    def close(self):
+        self.cur.close()
+
+class DbBenchmark:
+    '''Class for timing Db_query methods on a synthetic catalog in a temporary sqlite file'''
+    def __init__(self, config, files, tasks, ops, select_ops, work_dir=None):
+        """
+        Initialize class variables
+
+        Parameters
+        ----------
+        config : dict
+            config dictionary, its paths are replaced by the temporary directory
+        files : int
+            number of rows in 'Files' table
+        tasks : int
+            number of rows in 'ConversionTasks' table
+        ops : int
+            number of operations of every benchmark, split between processes
+        select_ops : int
+            number of operations of benchmarks reading the whole catalog
+        work_dir : str or None
+            directory for temporary database, system default if None
+
+        Attributes
+        ----------
+        config : dict
+            config pointing to temporary database
+        files : int
+            number of rows in 'Files' table
+        tasks : int
+            number of rows in 'ConversionTasks' table
+        ops : int
+            number of operations of every benchmark
+        select_ops : int
+            number of operations of benchmarks reading the whole catalog
+        temp_dir : str
+            temporary directory with database files
+        portal_db : str
+            path to sqlite file standing for Stalker Portal database
+        """
+        self.temp_dir = tempfile.mkdtemp(prefix='db_benchmark_', dir=work_dir)
+        self.config = {**config, 'path_to_main': self.temp_dir, 'sqlite3': 'catalog.sqlite'}
+        self.files = files
+        self.tasks = tasks
+        self.ops = ops
+        self.select_ops = select_ops
+        self.portal_db = os.path.join(self.temp_dir, 'portal.sqlite')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''
+        Remove temporary directory
+        '''
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def build(self, batch_size=10000):
+        '''
+        Fill temporary database with `files` files, half of them converted, `tasks` conversion
+        attempts and portal rows for every file, half of them mapped in 'PortalFiles'
+
+        Returns
+        -------
+        float
+            seconds spent
+        '''
+        started = time.perf_counter()
+        db_file = Db_query(self.config)
+        db_file.create_table()
+
+        records = (synthetic_record(catalog_filename(index), index) for index in range(self.files))
+        db_file.save_files_data(((record, streams_dicts(record), True, False) for record in records), batch_size)
+
+        with db_file.transaction() as conn:
+            conn.execute('UPDATE Files SET IsConverted=1 WHERE id % 2 = 0')
+        for start in range(0, self.tasks, batch_size):
+            with db_file.transaction() as conn:
+                conn.executemany('INSERT INTO ConversionTasks (file_id, status, start_time, end_time, check_integrity) VALUES (?, ?, ?, ?, ?)',
+                                 ((index % max(self.files, 1) + 1, 'done', '2024-01-01 00:00:00', '2024-01-01 01:00:00', 'No errors found')
+                                  for index in range(start, min(start + batch_size, self.tasks))))
+        with db_file.transaction() as conn:
+            conn.executemany('INSERT INTO PortalFiles (file_id, portal_id) VALUES (?, ?)',
+                             ((file_id, file_id) for file_id in range(1, self.files + 1, 2)))
+
+        portal = sqlite3.connect(self.portal_db)
+        portal.execute('PRAGMA journal_mode=WAL')
+        with portal:
+            portal.execute('CREATE TABLE video_series_files (id INTEGER PRIMARY KEY, url VARCHAR(255))')
+            portal.executemany('INSERT INTO video_series_files (id, url) VALUES (?, ?)',
+                               ((index + 1, 'http://portal' + catalog_filename(index)) for index in range(self.files)))
+        portal.close()
+        return time.perf_counter() - started
+
+    def run(self, benchmarks=BENCHMARKS, processes=(1,)):
+        '''
+        Run benchmarks with every number of concurrent processes
+
+        Parameters
+        ----------
+        benchmarks : iterable of str
+            names of benchmarks, see BENCHMARKS
+        processes : iterable of int
+            numbers of concurrent processes
+
+        Returns
+        -------
+        list of dict
+            results of `run_benchmark`
+        '''
+        return [self.run_benchmark(name, count) for name in benchmarks for count in processes]
+
+    def run_benchmark(self, name, processes):
+        '''
+        Run one benchmark, operations are split evenly between processes
+
+        Returns
+        -------
+        dict
+            benchmark, processes, operations, seconds, ops_per_second and latency_ms percentiles
+        '''
+        ops = self.select_ops if name in SELECT_BENCHMARKS else self.ops
+        shares = [ops // processes + (1 if worker < ops % processes else 0) for worker in range(processes)]
+        jobs = [(self.config, name, processes, worker, share, self.files, self.portal_db) for worker, share in enumerate(shares) if share]
+
+        writer = StatusWriter(self.config) if name == 'status_updates_buffered' else None
+        started = time.perf_counter()
+        if writer:
+            writer.start()  # workers inherit writer through fork
+        with Pool(processes=processes) as pool:
+            latencies = [latency for worker_latencies in pool.map(run_worker, jobs) for latency in worker_latencies]
+        if writer:
+            writer.stop()  # wall time includes commit of all buffered updates
+        seconds = time.perf_counter() - started
+
+        latencies.sort()
+        return {
+            'benchmark': name,
+            'processes': processes,
+            'operations': len(latencies),
+            'seconds': round(seconds, 6),
+            'ops_per_second': round(len(latencies) / seconds, 3) if seconds else None,
+            'latency_ms': {
+                'p50': round(percentile(latencies, 50) * 1000, 3),
+                'p95': round(percentile(latencies, 95) * 1000, 3),
+                'max': round(latencies[-1] * 1000, 3) if latencies else 0,
+            },
+        }
+
+    def metadata(self):
+        '''
+        Describe environment and catalog of the run
+        '''
+        return {
+            'files': self.files,
+            'tasks': self.tasks,
+            'ops': self.ops,
+            'select_ops': self.select_ops,
+            'sqlite_version': sqlite3.sqlite_version,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'sqlite_pragmas': Db_query(self.config).sqlite_pragmas,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        }
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+def run_worker(job):
+    '''
+    Run operations of one benchmark in a pool process
+
+    Returns
+    -------
+    list of float
+        seconds spent on every operation
+    '''
+    config, name, processes, worker, ops, files, portal_db = job
+    db_file = Db_query(config)
+    status_writer = StatusWriter(config)
+    flusher = OutboxFlusher(config, LocalPortal(portal_db))
+    rng = random.Random(worker)
+    latencies = []
+
+    for op in range(ops):
+        file_index = rng.randrange(files) if files else 0
+        started = time.perf_counter()
+        if name == 'save_file_data':
+            record = synthetic_record(f'/storage/benchmark/run{processes}/worker{worker}/film{op}.mkv', op)  # new file in every run
+            db_file.save_file_data(record, streams_dicts(record), True, False)
+        elif name == 'select_data':
+            sum(1 for _ in db_file.select_data())
+        elif name == 'select_directory_data':
+            sum(1 for _ in db_file.select_directory_data(os.path.dirname(catalog_filename(file_index)) + '/'))
+        elif name in ('status_updates', 'status_updates_buffered'):
+            writer = status_writer if name == 'status_updates_buffered' else db_file
+            record = synthetic_record(catalog_filename(file_index), file_index)
+            task_id = writer.update_status_of_conversion(file_index + 1, 'converting', '2024-01-01 00:00:00')
+            writer.update_status_ending_conversion('done', '2024-01-01 01:00:00', 'No errors found', task_id)
+            writer.update_files_table(record.filename, True, record, streams_dicts(record), file_index + 1)
+            writer.update_of_checking_integrity('done', '2024-01-01 01:00:00', 'No errors found', task_id)
+        elif name == 'update_url_file':
+            filename = catalog_filename(file_index)
+            db_file.update_url_file(filename, filename, file_index + 1)
+            flusher.flush_batch()
+        else:
+            raise ValueError(f'Unknown benchmark {name}')
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+# if __name__ == '__main__':
+#     pass
@@ -1,5 +1,8 @@
+from contextlib import contextmanager
 import os
 import sqlite3
+import threading
+import time
 import mariadb
 import json
 from custom_logging.logger import CustomLogger
@@ -7,6 +10,144 @@ from custom_logging.logger import CustomLogger
 custom_logger = CustomLogger(log_dir="logs", max_files=30, rotation_interval=30)
 logger = custom_logger.get_logger()
 
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 30000,
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+}
+
+# version of schema made by create_table, saved in PRAGMA user_version once migrate_tables succeeded.
+# Raise it whenever a table, column or index is added, so that existing databases are migrated
+SCHEMA_VERSION = 1
+
+# partial index holding only files left to convert, its condition must match select_pending_files
+PENDING_INDEX_QUERY = 'CREATE INDEX IF NOT EXISTS idx_files_pending ON Files(id) WHERE needs_conversion AND NOT IsConverted'
+
+# seconds of media in a file, probed duration or, when it is unknown, a guess from size and overall bit rate
+MEDIA_SECONDS = 'coalesce(nullif(Files.duration, 0), Files.size * 8.0 / nullif(Files.bit_rate, 0), 0)'
+# order of queued jobs of one kind by scheduling policy, longest or shortest estimated conversion first.
+# Speed of conversion is the same for all jobs of a kind, so media length stored at enqueue orders them by index
+JOB_ORDERS = {
+    'id': 'ConversionJobs.file_id',
+    'lpt': 'ConversionJobs.media_seconds DESC',
+    'spt': 'ConversionJobs.media_seconds',
+}
+# indexes of ConversionJobs, created with the table and by migrate_tables
+JOB_INDEX_QUERIES = (
+    'CREATE INDEX IF NOT EXISTS idx_conversionjobs_state ON ConversionJobs(state, file_id)',
+    'CREATE INDEX IF NOT EXISTS idx_conversionjobs_lease ON ConversionJobs(state, lease_until)',
+    'CREATE INDEX IF NOT EXISTS idx_conversionjobs_length ON ConversionJobs(state, is_film, media_seconds)',
+    'CREATE INDEX IF NOT EXISTS idx_conversionjobs_finished ON ConversionJobs(state, finished_at)',
+)
+
+# sqlite connections of current process by database file, shared by all Db_query instances
+_process_state = {'pid': None, 'lock': None, 'connections': {}, 'batch': False}
+# database files whose schema was checked by this process or its parent before fork
+_schema_checked = set()
+# connections inherited from parent process after fork, kept referenced so they are never closed in child
+_inherited_connections = []
+
+def _current_process_state():
+    if _process_state['pid'] != os.getpid():
+        _inherited_connections.extend(_process_state['connections'].values())
+        _process_state.update(pid=os.getpid(), lock=threading.RLock(), connections={}, batch=False)
+    return _process_state
+
+def select_audio_index(streams):
+    """
+    Select audio track to keep in converted file: rus track with default=1,
+    if not found first rus track
+
+    Parameters
+    ----------
+    streams : list of dict
+        list of streams as returned by Get_Info.streams_data
+
+    Returns
+    -------
+    int or None
+        index of selected stream or None if file has no rus audio
+    """
+    default_rus_index = None
+    first_rus_index = None
+
+    for stream in streams:
+        if stream['codec_type'] == 'audio':
+            language = stream.get('tags', {}).get('language', '')
+            is_default = stream.get('disposition', {}).get('default', 0)
+
+            if language == 'rus':
+                if is_default == 1:
+                    default_rus_index = stream['index']
+                if first_rus_index is None:
+                    first_rus_index = stream['index']
+
+    # Priority - track with default=1, if default=1 not found
+    if default_rus_index is not None:
+        return default_rus_index
+    return first_rus_index
+
+def stream_rows(data):
+    """
+    Rows of 'Streams' table for a probed file, without file_id
+
+    Parameters
+    ----------
+    data : ProbeRecord
+        data of the file, returned by ffprobe
+
+    Returns
+    -------
+    list of tuple
+        (stream_index, codec_type, codec_name, language, is_default, title)
+    """
+    return [(stream.index, stream.codec_type, stream.codec_name, stream.language or None, bool(stream.is_default), stream.title or None)
+            for stream in data.streams]
+
+def needs_conversion(nb_streams):
+    """Files with more than 2 streams are converted"""
+    return nb_streams is not None and nb_streams > 2
+
+# columns by which 'CatalogStats' groups files, NULL is counted as False
+STATS_COLUMNS = ('IsFilm', 'IsSerial', 'IsConverted', 'needs_conversion')
+
+def stats_key(row):
+    """Values of STATS_COLUMNS of NEW or OLD row in a trigger"""
+    return ', '.join(f'coalesce({row}.{column}, 0) != 0' for column in STATS_COLUMNS)
+
+def stats_match(row):
+    """Condition selecting row of 'CatalogStats' of NEW or OLD row in a trigger"""
+    return ' AND '.join(f'{column} = (coalesce({row}.{column}, 0) != 0)' for column in STATS_COLUMNS)
+
+STATS_TRIGGERS = (
+    f"""CREATE TRIGGER IF NOT EXISTS trg_files_stats_insert AFTER INSERT ON Files BEGIN
+        INSERT INTO CatalogStats ({', '.join(STATS_COLUMNS)}, files, bytes) VALUES ({stats_key('NEW')}, 1, coalesce(NEW.size, 0))
+        ON CONFLICT ({', '.join(STATS_COLUMNS)}) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_files_stats_delete AFTER DELETE ON Files BEGIN
+        UPDATE CatalogStats SET files = files - 1, bytes = bytes - coalesce(OLD.size, 0) WHERE {stats_match('OLD')};
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_files_stats_update AFTER UPDATE OF {', '.join(STATS_COLUMNS)}, size ON Files BEGIN
+        UPDATE CatalogStats SET files = files - 1, bytes = bytes - coalesce(OLD.size, 0) WHERE {stats_match('OLD')};
+        INSERT INTO CatalogStats ({', '.join(STATS_COLUMNS)}, files, bytes) VALUES ({stats_key('NEW')}, 1, coalesce(NEW.size, 0))
+        ON CONFLICT ({', '.join(STATS_COLUMNS)}) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_tasks_stats_insert AFTER INSERT ON ConversionTasks BEGIN
+        INSERT INTO TaskStats (status, tasks) VALUES (coalesce(NEW.status, ''), 1)
+        ON CONFLICT (status) DO UPDATE SET tasks = tasks + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_tasks_stats_delete AFTER DELETE ON ConversionTasks BEGIN
+        UPDATE TaskStats SET tasks = tasks - 1 WHERE status = coalesce(OLD.status, '');
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_tasks_stats_update AFTER UPDATE OF status ON ConversionTasks BEGIN
+        UPDATE TaskStats SET tasks = tasks - 1 WHERE status = coalesce(OLD.status, '');
+        INSERT INTO TaskStats (status, tasks) VALUES (coalesce(NEW.status, ''), 1)
+        ON CONFLICT (status) DO UPDATE SET tasks = tasks + 1;
+    END""",
+)
+
 class Db_query():
     def __init__(self, config):
         """
@@ -27,10 +168,78 @@ class Db_query():
             config of maria database
         log_file : str
             path to log file
+        sqlite_pragmas : dict
+            pragmas applied to every sqlite connection, SQLITE_PRAGMAS updated with 'sqlite_pragmas' from config
+        page_size : int
+            number of rows read at once when selecting files to convert
         """
         self.config = config
         self.db_file = os.path.join(config['path_to_main'], config['sqlite3'])
         self.maria_db = config['maria_db']
+        self.sqlite_pragmas = {**SQLITE_PRAGMAS, **config.get('sqlite_pragmas', {})}
+        self.page_size = config.get('select_page_size', 1000)
+        if self.db_file not in _schema_checked:
+            _schema_checked.add(self.db_file)
+            self.ensure_schema()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Use sqlite connection of current process in a transaction, committed on success
+        and rolled back on error. Threads of one process take turns on the connection.
+
+        Yields
+        ------
+        sqlite3.Connection
+        """
+        state = _current_process_state()
+        with state['lock']:
+            conn = self.connection()
+            if state['batch']:
+                yield conn  # committed when batch ends
+            else:
+                with conn:
+                    yield conn
+
+    @contextmanager
+    def batch(self):
+        """
+        Group calls of Db_query methods made by this thread into one transaction,
+        committed when the block ends. Other threads of the process wait until then.
+
+        Yields
+        ------
+        sqlite3.Connection
+        """
+        state = _current_process_state()
+        with state['lock']:
+            conn = self.connection()
+            state['batch'] = True
+            try:
+                with conn:
+                    yield conn
+            finally:
+                state['batch'] = False
+
+    def connection(self):
+        """
+        Get sqlite connection of current process, it is created on first use with `sqlite_pragmas`
+        and shared by all instances of Db_query in the process.
+
+        A connection inherited through fork is never used nor closed in the child,
+        the child opens its own.
+
+        Returns
+        -------
+        sqlite3.Connection
+        """
+        connections = _current_process_state()['connections']
+        if self.db_file not in connections:
+            conn = sqlite3.connect(self.db_file, timeout=self.sqlite_pragmas['busy_timeout'] / 1000, check_same_thread=False)
+            for name, value in self.sqlite_pragmas.items():
+                conn.execute(f'PRAGMA {name}={value}')
+            connections[self.db_file] = conn
+        return connections[self.db_file]
 
     def table_exists(self, table_name):
         """
@@ -46,7 +255,7 @@ class Db_query():
         bool
             True if table exists, False otherwise
         """
-        with sqlite3.connect(self.db_file) as conn:
+        with self.transaction() as conn:
             cur = conn.cursor()
             if not cur:
                 return False
@@ -57,13 +266,39 @@ class Db_query():
                 logger.error(f'Error executing query: {e}')
                 return False
 
+    def ensure_schema(self):
+        """
+        Create missing tables and migrate tables of a database made by an older version.
+        Called once per process by the first Db_query of a database, a database without
+        'Files' table is left to create_tables_db.py. A database at SCHEMA_VERSION is only read.
+        """
+        if self.table_exists('Files') and self.schema_version() < SCHEMA_VERSION:
+            self.create_table()
+
+    def schema_version(self):
+        """
+        Version of schema saved by migrate_tables, 0 for databases made by older versions
+
+        Returns
+        -------
+        int
+        """
+        try:
+            with self.transaction() as conn:
+                return conn.execute('PRAGMA user_version').fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error(f'Error reading schema version: {e}')
+            return 0
+
     def create_table(self):
         """
         Create tables in database if they do not exist
 
-        This function creates 'Files' and 'ConversionTasks' tables in database if they do not exist.
+        This function creates 'Files', 'Streams', 'ConversionTasks', 'ConversionJobs', 'ProbeCache', 'ProbeFailures',
+        'DirSnapshots', 'PortalOutbox', 'PortalFiles' and 'PortalSyncState' tables in database if they do not exist
+        and migrates tables created by older versions.
         """
-        with sqlite3.connect(self.db_file) as conn:
+        with self.transaction() as conn:
             cur = conn.cursor()
             if not cur:
                 return
@@ -78,15 +313,40 @@ class Db_query():
                             nb_streams INTEGER,
                             size INTEGER,
                             bit_rate INTEGER,
-                            streams VARCHAR(255)
+                            streams VARCHAR(255),
+                            audio_index INTEGER,
+                            video_codec VARCHAR(255),
+                            needs_conversion BOOLEAN,
+                            duration REAL
                 );"""
                 try:
                     cur.execute(create_table_query1)
+                    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_files_filename ON Files(filename)')
+                    cur.execute(PENDING_INDEX_QUERY)
                     conn.commit()
                     print("Table 'Files' created successfully")
                 except sqlite3.Error as e:
                     logger.error(f'Error creating table Files: {e}')
             
+            if not self.table_exists('Streams'):
+                create_table_query5 = """CREATE TABLE IF NOT EXISTS Streams(
+                            file_id INTEGER NOT NULL REFERENCES Files(id),
+                            stream_index INTEGER NOT NULL,
+                            codec_type VARCHAR(255),
+                            codec_name VARCHAR(255),
+                            language VARCHAR(255),
+                            is_default BOOLEAN,
+                            title VARCHAR(255),
+                            PRIMARY KEY (file_id, stream_index)
+                );"""
+                try:
+                    cur.execute(create_table_query5)
+                    self.create_streams_indexes(cur)
+                    conn.commit()
+                    print("Table 'Streams' created successfully")
+                except sqlite3.Error as e:
+                    logger.error(f'Error creating table Streams: {e}')
+
             if not self.table_exists('ConversionTasks'):
                 create_table_query2 = """CREATE TABLE IF NOT EXISTS ConversionTasks(
                             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -98,19 +358,348 @@ class Db_query():
                 );"""
                 try:
                     cur.execute(create_table_query2)
+                    cur.execute('CREATE INDEX IF NOT EXISTS idx_conversiontasks_file_id ON ConversionTasks(file_id)')
+                    cur.execute('CREATE INDEX IF NOT EXISTS idx_conversiontasks_status ON ConversionTasks(status)')
                     conn.commit()
                     print("Table 'ConversionTasks' created successfully")
                 except sqlite3.Error as e:
                     logger.error(f'Error creating table ConversionTasks: {e}')
-            
+
+            if not self.table_exists('ConversionJobs'):
+                create_table_query9 = """CREATE TABLE IF NOT EXISTS ConversionJobs(
+                            file_id INTEGER PRIMARY KEY REFERENCES Files(id),
+                            state VARCHAR(255),
+                            owner VARCHAR(255),
+                            lease_until REAL,
+                            attempts INTEGER DEFAULT 0,
+                            queued_at REAL,
+                            claimed_at REAL,
+                            finished_at REAL,
+                            media_seconds REAL,
+                            estimated_seconds REAL,
+                            is_film BOOLEAN
+                );"""
+                try:
+                    cur.execute(create_table_query9)
+                    for query in JOB_INDEX_QUERIES:
+                        cur.execute(query)
+                    conn.commit()
+                    print("Table 'ConversionJobs' created successfully")
+                except sqlite3.Error as e:
+                    logger.error(f'Error creating table ConversionJobs: {e}')
+
+            if not self.table_exists('ProbeCache'):
+                create_table_query3 = """CREATE TABLE IF NOT EXISTS ProbeCache(
+                            path VARCHAR(255) PRIMARY KEY,
+                            size INTEGER,
+                            mtime_ns INTEGER,
+                            inode INTEGER,
+                            probe TEXT
+                );"""
+                try:
+                    cur.execute(create_table_query3)
+                    conn.commit()
+                    print("Table 'ProbeCache' created successfully")
+                except sqlite3.Error as e:
+                    logger.error(f'Error creating table ProbeCache: {e}')
+
+            if not self.table_exists('ProbeFailures'):
+                create_table_query10 = """CREATE TABLE IF NOT EXISTS ProbeFailures(
+                            path VARCHAR(255) PRIMARY KEY,
+                            size INTEGER,
+                            mtime_ns INTEGER
+                );"""
+                try:
+                    cur.execute(create_table_query10)
+                    conn.commit()
+                    print("Table 'ProbeFailures' created successfully")
+                except sqlite3.Error as e:
+                    logger.error(f'Error creating table ProbeFailures: {e}')
+
+            if not self.table_exists('DirSnapshots'):
+                create_table_query4 = """CREATE TABLE IF NOT EXISTS DirSnapshots(
+                            path VARCHAR(255) PRIMARY KEY,
+                            parent VARCHAR(255),
+                            mtime_ns INTEGER
+                );"""
+                try:
+                    cur.execute(create_table_query4)
+                    conn.commit()
+                    print("Table 'DirSnapshots' created successfully")
+                except sqlite3.Error as e:
+                    logger.error(f'Error creating table DirSnapshots: {e}')
+
+            if not self.table_exists('PortalOutbox'):
+                create_table_query6 = """CREATE TABLE IF NOT EXISTS PortalOutbox(
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            file_id INTEGER REFERENCES Files(id),
+                            filename VARCHAR(255),
+                            output_file VARCHAR(255),
+                            created_at REAL,
+                            attempts INTEGER DEFAULT 0,
+                            next_attempt REAL,
+                            last_error TEXT,
+                            dead BOOLEAN DEFAULT 0
+                );"""
+                try:
+                    cur.execute(create_table_query6)
+                    cur.execute('CREATE INDEX IF NOT EXISTS idx_portaloutbox_next_attempt ON PortalOutbox(next_attempt)')
+                    conn.commit()
+                    print("Table 'PortalOutbox' created successfully")
+                except sqlite3.Error as e:
+                    logger.error(f'Error creating table PortalOutbox: {e}')
+
+            if not self.table_exists('PortalFiles'):
+                create_table_query7 = """CREATE TABLE IF NOT EXISTS PortalFiles(
+                            file_id INTEGER NOT NULL REFERENCES Files(id),
+                            portal_id INTEGER NOT NULL,
+                            PRIMARY KEY (file_id, portal_id)
+                );"""
+                try:
+                    cur.execute(create_table_query7)
+                    conn.commit()
+                    print("Table 'PortalFiles' created successfully")
+                except sqlite3.Error as e:
+                    logger.error(f'Error creating table PortalFiles: {e}')
+
+            if not self.table_exists('PortalSyncState'):
+                create_table_query8 = """CREATE TABLE IF NOT EXISTS PortalSyncState(
+                            name VARCHAR(255) PRIMARY KEY,
+                            value INTEGER
+                );"""
+                try:
+                    cur.execute(create_table_query8)
+                    conn.commit()
+                    print("Table 'PortalSyncState' created successfully")
+                except sqlite3.Error as e:
+                    logger.error(f'Error creating table PortalSyncState: {e}')
+
+        self.migrate_tables()
+
+    def migrate_tables(self):
+        """
+        Add columns missing in tables created by older versions and fill them.
+        SCHEMA_VERSION is saved when all steps succeeded.
+        """
+        with self.transaction() as conn:
+            cur = conn.cursor()
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            complete = True
+            try:
+                cur.execute('PRAGMA table_info(Files)')
+                columns = {row[1] for row in cur.fetchall()}
+                if 'needs_conversion' not in columns:
+                    cur.execute('ALTER TABLE Files ADD COLUMN audio_index INTEGER')
+                    cur.execute('ALTER TABLE Files ADD COLUMN video_codec VARCHAR(255)')
+                    cur.execute('ALTER TABLE Files ADD COLUMN needs_conversion BOOLEAN')
+                    cur.execute('SELECT id, nb_streams, streams FROM Files')
+                    cur.executemany('UPDATE Files SET audio_index=?, needs_conversion=? WHERE id=?',
+                                    [(select_audio_index(json.loads(streams or '[]')), needs_conversion(nb_streams), file_id)
+                                     for file_id, nb_streams, streams in cur.fetchall()])
+                    conn.commit()
+                    print("Table 'Files' migrated: audio_index, video_codec, needs_conversion")
+                cur.execute('PRAGMA table_info(Files)')
+                if 'duration' not in {row[1] for row in cur.fetchall()}:
+                    cur.execute('ALTER TABLE Files ADD COLUMN duration REAL')
+                    cur.execute("""UPDATE Files SET duration=(SELECT json_extract(probe, '$.format.duration') FROM ProbeCache WHERE path=Files.filename)
+                                   WHERE filename IN (SELECT path FROM ProbeCache)""")  #files probed since cache exists
+                    cur.execute(f"""UPDATE ConversionJobs SET media_seconds=(SELECT {MEDIA_SECONDS} FROM Files WHERE Files.id=ConversionJobs.file_id)
+                                    WHERE state='queued'""")
+                    conn.commit()
+                    print("Table 'Files' migrated: duration")
+            except (sqlite3.Error, json.JSONDecodeError) as e:
+                complete = False
+                logger.error(f'Error migrating table Files: {e}')
+
+            try:
+                cur.execute('PRAGMA table_info(PortalOutbox)')
+                if 'file_id' not in {row[1] for row in cur.fetchall()}:
+                    cur.execute('ALTER TABLE PortalOutbox ADD COLUMN file_id INTEGER REFERENCES Files(id)')
+                    conn.commit()
+                    print("Table 'PortalOutbox' migrated: file_id")
+                cur.execute('PRAGMA table_info(PortalOutbox)')
+                if 'dead' not in {row[1] for row in cur.fetchall()}:
+                    cur.execute('ALTER TABLE PortalOutbox ADD COLUMN dead BOOLEAN DEFAULT 0')
+                    conn.commit()
+                    print("Table 'PortalOutbox' migrated: dead")
+            except sqlite3.Error as e:
+                complete = False
+                logger.error(f'Error migrating table PortalOutbox: {e}')
+
+            try:
+                cur.execute('PRAGMA table_info(ConversionJobs)')
+                if 'finished_at' not in {row[1] for row in cur.fetchall()}:
+                    cur.execute('ALTER TABLE ConversionJobs ADD COLUMN finished_at REAL')
+                    cur.execute('ALTER TABLE ConversionJobs ADD COLUMN media_seconds REAL')
+                    cur.execute('ALTER TABLE ConversionJobs ADD COLUMN estimated_seconds REAL')
+                    conn.commit()
+                    print("Table 'ConversionJobs' migrated: finished_at, media_seconds, estimated_seconds")
+                cur.execute('PRAGMA table_info(ConversionJobs)')
+                if 'is_film' not in {row[1] for row in cur.fetchall()}:
+                    cur.execute('ALTER TABLE ConversionJobs ADD COLUMN is_film BOOLEAN')
+                    cur.execute(f"""UPDATE ConversionJobs SET is_film=(SELECT coalesce(IsFilm, 0) FROM Files WHERE Files.id=ConversionJobs.file_id),
+                                                             media_seconds=(SELECT {MEDIA_SECONDS} FROM Files WHERE Files.id=ConversionJobs.file_id)
+                                    WHERE state='queued'""")
+                    conn.commit()
+                    print("Table 'ConversionJobs' migrated: is_film")
+                for query in JOB_INDEX_QUERIES:
+                    cur.execute(query)
+                conn.commit()
+            except sqlite3.Error as e:
+                complete = False
+                logger.error(f'Error migrating table ConversionJobs: {e}')
+
+            try:
+                cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_files_filename ON Files(filename)')
+                conn.commit()
+            except sqlite3.IntegrityError as e:
+                complete = False
+                logger.error(f'Error creating unique index on Files.filename, remove duplicate filenames first: {e}')
+
+            try:
+                cur.execute(PENDING_INDEX_QUERY)
+                conn.commit()
+            except sqlite3.Error as e:
+                complete = False
+                logger.error(f'Error creating index of pending files: {e}')
+
+            try:
+                # streams of files saved by older versions are kept as json in Files.streams,
+                # copied once, current versions never write it
+                if version < SCHEMA_VERSION:
+                    self.copy_json_streams(cur)
+                self.create_streams_indexes(cur)
+                conn.commit()
+            except sqlite3.Error as e:
+                complete = False
+                logger.error(f'Error migrating Files.streams to table Streams: {e}')
+
+            try:
+                cur.execute('CREATE INDEX IF NOT EXISTS idx_conversiontasks_file_id ON ConversionTasks(file_id)')
+                cur.execute('CREATE INDEX IF NOT EXISTS idx_conversiontasks_status ON ConversionTasks(status)')
+                conn.commit()
+            except sqlite3.Error as e:
+                complete = False
+                logger.error(f'Error creating indexes on ConversionTasks: {e}')
+
+            if complete:
+                cur.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+                conn.commit()
+
+        if not self.table_exists('CatalogStats'):
+            self.create_catalog_stats()
+
+    def create_catalog_stats(self):
+        """
+        Create 'CatalogStats' and 'TaskStats' tables, fill them from 'Files' and 'ConversionTasks'
+        and create triggers which keep them up to date on every write
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute(f"""CREATE TABLE IF NOT EXISTS CatalogStats(
+                            {' BOOLEAN NOT NULL, '.join(STATS_COLUMNS)} BOOLEAN NOT NULL,
+                            files INTEGER NOT NULL,
+                            bytes INTEGER NOT NULL,
+                            PRIMARY KEY ({', '.join(STATS_COLUMNS)})
+                );""")
+                cur.execute("""CREATE TABLE IF NOT EXISTS TaskStats(
+                            status VARCHAR(255) PRIMARY KEY,
+                            tasks INTEGER NOT NULL
+                );""")
+                self.fill_catalog_stats(cur)
+                for trigger in STATS_TRIGGERS:
+                    cur.execute(trigger)
+                print("Tables 'CatalogStats' and 'TaskStats' created successfully")
+        except sqlite3.Error as e:
+            logger.error(f'Error creating catalog stats: {e}')
+
+    def fill_catalog_stats(self, cur):
+        """
+        Count statistics from 'Files' and 'ConversionTasks' tables with a full scan
+
+        Parameters
+        ----------
+        cur : sqlite3.Cursor
+            cursor of open transaction
+        """
+        keys = ', '.join(f'coalesce({column}, 0) != 0' for column in STATS_COLUMNS)
+        cur.execute('DELETE FROM CatalogStats')
+        cur.execute(f'INSERT INTO CatalogStats SELECT {keys}, count(*), coalesce(sum(size), 0) FROM Files GROUP BY {keys}')
+        cur.execute('DELETE FROM TaskStats')
+        cur.execute("INSERT INTO TaskStats SELECT coalesce(status, ''), count(*) FROM ConversionTasks GROUP BY coalesce(status, '')")
+
+    def rebuild_catalog_stats(self):
+        """
+        Recount 'CatalogStats' and 'TaskStats' tables, e.g. after rows were changed with triggers disabled
+        """
+        try:
+            with self.transaction() as conn:
+                self.fill_catalog_stats(conn.cursor())
+        except sqlite3.Error as e:
+            logger.error(f'Error rebuilding catalog stats: {e}')
+
+    def select_catalog_stats(self):
+        """
+        Read catalog statistics, the tables hold one row per group so reading does not depend on catalog size
+
+        Returns
+        -------
+        tuple
+            (files, tasks) where files is a list of (IsFilm, IsSerial, IsConverted, needs_conversion, files, bytes)
+            and tasks is a list of (status, tasks)
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute(f'SELECT {", ".join(STATS_COLUMNS)}, files, bytes FROM CatalogStats WHERE files != 0 ORDER BY {", ".join(STATS_COLUMNS)}')
+                files = cur.fetchall()
+                cur.execute('SELECT status, tasks FROM TaskStats WHERE tasks != 0 ORDER BY status')
+                return files, cur.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting catalog stats: {e}')
+            return [], []
+
+    def create_streams_indexes(self, cur):
+        """
+        Create covering indexes of 'Streams' table: by file for selecting tracks of one file
+        and by codec type and language for planning queries over the whole catalog
+
+        Parameters
+        ----------
+        cur : sqlite3.Cursor
+            cursor of open transaction
+        """
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_streams_file_type ON Streams(file_id, codec_type, language, is_default, stream_index)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_streams_type_language ON Streams(codec_type, language, file_id)')
+
+    def copy_json_streams(self, cur):
+        """
+        Copy streams kept as json in Files.streams by older versions to 'Streams' table and clear them
+
+        Parameters
+        ----------
+        cur : sqlite3.Cursor
+            cursor of open transaction
+        """
+        cur.execute("""INSERT OR IGNORE INTO Streams (file_id, stream_index, codec_type, codec_name, language, is_default, title)
+                       SELECT Files.id, json_extract(stream.value, '$.index'), json_extract(stream.value, '$.codec_type'),
+                              json_extract(stream.value, '$.codec_name'), json_extract(stream.value, '$.tags.language'),
+                              coalesce(json_extract(stream.value, '$.disposition.default'), 0) = 1, json_extract(stream.value, '$.tags.title')
+                       FROM Files, json_each(Files.streams) AS stream
+                       WHERE Files.streams IS NOT NULL AND json_valid(Files.streams)""")
+        if cur.rowcount > 0:
+            print(f"Table 'Streams' filled with {cur.rowcount} streams from Files.streams")
+        cur.execute('UPDATE Files SET streams=NULL WHERE streams IS NOT NULL AND json_valid(streams)')
+
     def save_file_data(self, data, streams, is_film, is_serial):
         """
         Save file data to the database.
 
         Parameters
         ----------
-        data : dict
-            Data of the file, returned by ffmpeg.
+        data : ProbeRecord
+            Data of the file, returned by ffprobe.
         streams : list of dict
             List of streams of the file.
         is_film : bool
@@ -118,84 +707,703 @@ class Db_query():
         is_serial : bool
             Flag indicating if the file is a serial.
         """
-        with sqlite3.connect(self.db_file) as conn:
-            cur = conn.cursor()
-            cur.execute('SELECT * FROM Files WHERE filename = ?', (data['format']['filename'],))
-            
-            if cur.fetchone() is None:
-                try:
-                    filename = data['format'].get('filename')
-                    nb_streams = data['format'].get('nb_streams')
-                    size = data['format'].get('size')
-                    bit_rate = data['format'].get('bit_rate')  
-
-                    if filename:
-                        cur.execute("""INSERT INTO Files (filename, IsFilm, IsSerial, IsConverted, nb_streams, size, bit_rate, streams)  
-                                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                                        (filename, is_film, is_serial, False, nb_streams, size, bit_rate, json.dumps(streams)))
-                        conn.commit()
-                    else:
-                        logger.error("Filename is missing in the data.")
-                
-                except sqlite3.Error as e:
-                    logger.error(f'Error inserting data: {e}')
-            else:
-                print(f"Data already exists for {data['format']['filename']}")
+        if not data.filename:
+            logger.error("Filename is missing in the data.")
+            return
+
+        inserted, _ = self.save_files_data([(data, streams, is_film, is_serial)])
+        if not inserted:
+            print(f"Data already exists for {data.filename}")
+
+    def conversion_plan(self, data, streams):
+        """
+        Decide how file is converted, stored in 'Files' so that workers do not parse streams
+
+        Parameters
+        ----------
+        data : ProbeRecord
+            Data of the file, returned by ffprobe.
+        streams : list of dict
+            List of streams of the file.
+
+        Returns
+        -------
+        tuple
+            (audio_index, video_codec, needs_conversion)
+        """
+        video_codec = next((stream.codec_name for stream in data.streams if stream.codec_type == 'video'), None)
+        return select_audio_index(streams), video_codec, needs_conversion(data.nb_streams)
+
+    def save_files_data(self, files, batch_size=500):
+        """
+        Save data of many files to the database.
+
+        Rows are inserted one transaction per `batch_size` files, streams of every
+        inserted file go to 'Streams' table in the same transaction. Files whose filename
+        is already in 'Files' table are skipped by the unique index, with their streams.
+
+        Parameters
+        ----------
+        files : iterable of tuples
+            (data, streams, is_film, is_serial) as accepted by `save_file_data`
+        batch_size : int
+            number of files inserted in one transaction
+
+        Returns
+        -------
+        tuple
+            (inserted, skipped) number of inserted files and files already in database
+        """
+        inserted = 0
+        skipped = 0
+
+        def flush(rows):
+            count = 0
+            streams_rows = []
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                for row, file_streams in rows:
+                    cur.execute("""INSERT INTO Files (filename, IsFilm, IsSerial, IsConverted, nb_streams, size, bit_rate, duration, audio_index, video_codec, needs_conversion)
+                                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                   ON CONFLICT(filename) DO NOTHING RETURNING id""", row)
+                    inserted_row = cur.fetchone()
+                    if inserted_row is not None:  # None if file is already in database
+                        count += 1
+                        streams_rows.extend((inserted_row[0], *stream) for stream in file_streams)
+                cur.executemany("""INSERT OR IGNORE INTO Streams (file_id, stream_index, codec_type, codec_name, language, is_default, title)
+                                   VALUES (?, ?, ?, ?, ?, ?, ?)""", streams_rows)
+            return count
+
+        try:
+            rows = []
+            for data, streams, is_film, is_serial in files:
+                if not data.filename:
+                    logger.error("Filename is missing in the data.")
+                    continue
+                rows.append(((data.filename, is_film, is_serial, False, data.nb_streams, data.size, data.bit_rate, data.duration, *self.conversion_plan(data, streams)),
+                             stream_rows(data)))
+                if len(rows) >= batch_size:
+                    count = flush(rows)
+                    inserted += count
+                    skipped += len(rows) - count
+                    rows = []
+            if rows:
+                count = flush(rows)
+                inserted += count
+                skipped += len(rows) - count
+        except sqlite3.Error as e:
+            logger.error(f'Error inserting data: {e}')
+        return inserted, skipped
+
+    def get_cached_probe(self, path, size, mtime_ns, inode):
+        """
+        Get cached ffprobe output for a file if the file has not changed since it was probed
+
+        Parameters
+        ----------
+        path : str
+            path to file
+        size : int
+            size of file in bytes
+        mtime_ns : int
+            modification time of file in nanoseconds
+        inode : int
+            inode number of file
+
+        Returns
+        -------
+        dict or None
+            cached ffprobe output or None if there is no valid entry
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT probe FROM ProbeCache WHERE path=? AND size=? AND mtime_ns=? AND inode=?', (path, size, mtime_ns, inode))
+                row = cur.fetchone()
+                return json.loads(row[0]) if row else None
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            logger.error(f'Error selecting cached probe: {e}')
+            return None
+
+    def save_cached_probe(self, path, size, mtime_ns, inode, probe):
+        """
+        Save ffprobe output for a file to cache. An existing entry for the same path is replaced
+        and a failed probe recorded for the path is removed.
+
+        Parameters
+        ----------
+        path : str
+            path to file
+        size : int
+            size of file in bytes
+        mtime_ns : int
+            modification time of file in nanoseconds
+        inode : int
+            inode number of file
+        probe : dict
+            output of ffprobe command
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute('INSERT OR REPLACE INTO ProbeCache (path, size, mtime_ns, inode, probe) VALUES (?, ?, ?, ?, ?)', (path, size, mtime_ns, inode, json.dumps(probe)))
+                cur.execute('DELETE FROM ProbeFailures WHERE path=?', (path,))
+        except sqlite3.Error as e:
+            logger.error(f'Error inserting cached probe: {e}')
+
+    def invalidate_probe_cache(self, path=None):
+        """
+        Remove cached ffprobe output and recorded failed probe for a file, or the whole cache if path is None
+
+        Parameters
+        ----------
+        path : str, optional
+            path to file
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                if path is None:
+                    cur.execute('DELETE FROM ProbeCache')
+                    cur.execute('DELETE FROM ProbeFailures')
+                else:
+                    cur.execute('DELETE FROM ProbeCache WHERE path=?', (path,))
+                    cur.execute('DELETE FROM ProbeFailures WHERE path=?', (path,))
+        except sqlite3.Error as e:
+            logger.error(f'Error deleting cached probe: {e}')
+
+    def probe_failed(self, path, size, mtime_ns):
+        """
+        Check if probing a file failed and the file has not changed since
+
+        Parameters
+        ----------
+        path : str
+            path to file
+        size : int
+            size of file in bytes
+        mtime_ns : int
+            modification time of file in nanoseconds
+
+        Returns
+        -------
+        bool
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT 1 FROM ProbeFailures WHERE path=? AND size=? AND mtime_ns=?', (path, size, mtime_ns))
+                return cur.fetchone() is not None
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting failed probe: {e}')
+            return False
+
+    def save_probe_failure(self, path, size, mtime_ns):
+        """
+        Record a file that could not be probed, it is probed again only after its size or mtime changes
+
+        Parameters
+        ----------
+        path : str
+            path to file
+        size : int
+            size of file in bytes
+        mtime_ns : int
+            modification time of file in nanoseconds
+        """
+        try:
+            with self.transaction() as conn:
+                conn.execute('INSERT OR REPLACE INTO ProbeFailures (path, size, mtime_ns) VALUES (?, ?, ?)', (path, size, mtime_ns))
+        except sqlite3.Error as e:
+            logger.error(f'Error inserting failed probe: {e}')
+
+    def select_probe_failures(self, directory):
+        """
+        Select files in directory and all its subdirectories that could not be probed
+
+        Parameters
+        ----------
+        directory : str
+            path to directory
+
+        Returns
+        -------
+        list of str
+            paths of files
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT path FROM ProbeFailures WHERE path>? AND path<?', (directory + '/', directory + '0'))  #'0' follows '/', so range covers the subtree
+                return [row[0] for row in cur.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting failed probes: {e}')
+            return []
+
+    def delete_probe_failures(self, paths):
+        """
+        Remove recorded failed probes of files that no longer exist
+
+        Parameters
+        ----------
+        paths : list of str
+            paths of files
+        """
+        try:
+            with self.transaction() as conn:
+                conn.executemany('DELETE FROM ProbeFailures WHERE path=?', [(path,) for path in paths])
+        except sqlite3.Error as e:
+            logger.error(f'Error deleting failed probes: {e}')
+
+    def evict_probe_cache(self, max_entries):
+        """
+        Remove the oldest entries from cache so that at most max_entries remain
+
+        Parameters
+        ----------
+        max_entries : int
+            maximum number of entries to keep
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute('''DELETE FROM ProbeCache WHERE rowid IN (
+                                SELECT rowid FROM ProbeCache ORDER BY rowid
+                                LIMIT MAX((SELECT COUNT(*) FROM ProbeCache) - ?, 0))''', (max_entries,))
+        except sqlite3.Error as e:
+            logger.error(f'Error evicting cached probes: {e}')
+
+    def select_dir_snapshots(self, directory):
+        """
+        Select saved mtimes of directory and all its subdirectories
+
+        Parameters
+        ----------
+        directory : str
+            path to directory
+
+        Returns
+        -------
+        list of tuples
+            list of (path, parent, mtime_ns)
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT path, parent, mtime_ns FROM DirSnapshots WHERE path=? OR (path>? AND path<?)', (directory, directory + '/', directory + '0'))  #'0' follows '/', so range covers the subtree
+                return cur.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting data: {e}')
+            return []
+
+    def save_dir_snapshots(self, snapshots, removed_dirs):
+        """
+        Save mtimes of listed directories and remove snapshots of deleted directories
+
+        Parameters
+        ----------
+        snapshots : list of tuples
+            list of (path, parent, mtime_ns)
+        removed_dirs : list of str
+            directories that no longer exist, their subtrees are removed as well
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.executemany('DELETE FROM DirSnapshots WHERE path=? OR (path>? AND path<?)', [(path, path + '/', path + '0') for path in removed_dirs])
+                cur.executemany('INSERT OR REPLACE INTO DirSnapshots (path, parent, mtime_ns) VALUES (?, ?, ?)', snapshots)
+        except sqlite3.Error as e:
+            logger.error(f'Error updating data: {e}')
+
+    def interrupted_program(self, current_time, task_id):
+        """
+        Update ConversionTasks table with status 'Error: check logs' and current time if program is interrupted
+        
+        Parameters
+        ----------
+        current_time : str
+            current date and time in format '%Y-%m-%d %H:%M:%S'
+        task_id : int
+            id of conversion attempt returned by `update_status_of_conversion`
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute('UPDATE ConversionTasks SET status=?, end_time=? WHERE id=?', ('Conversion interrupted', current_time, task_id))  #update if program interrupted
+        except sqlite3.Error as e:
+            logger.error(f'Error updating data: {e}')
+
+    def select_pending_files(self, condition='', params=(), page_size=None):
+        """
+        Select files which need conversion and are not converted yet.
+
+        Rows are read in pages ordered by id, every page in its own short read, so that
+        no transaction stays open while files are converted and at most one page is in memory.
+
+        Parameters
+        ----------
+        condition : str
+            additional sql condition, starting with AND
+        params : tuple
+            parameters of `condition`
+        page_size : int or None
+            number of rows in one page, `page_size` of the instance if None
+
+        Yields
+        ------
+        tuple
+            id, IsFilm, IsConverted, filename, needs_conversion, audio_index of file
+        """
+        page_size = page_size or self.page_size
+        last_id = 0
+        while True:
+            try:
+                with self.transaction() as conn:
+                    cur = conn.cursor()
+                    cur.execute(f"""SELECT id, IsFilm, IsConverted, filename, needs_conversion, audio_index FROM Files
+                                    WHERE needs_conversion AND NOT IsConverted AND id > ? {condition}
+                                    ORDER BY id LIMIT ?""", (last_id, *params, page_size))  #select data from database
+                    rows = cur.fetchall()
+            except sqlite3.Error as e:
+                logger.error(f'Error selecting data: {e}')
+                return
+            yield from rows
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1][0]
+
+    def select_data(self):
+        """
+        Select files to convert from database
+
+        Yields
+        ------
+        tuple
+            id, IsFilm, IsConverted, filename, needs_conversion, audio_index of file
+        """
+        return self.select_pending_files()
+
+    def select_single_data(self, filename):
+        return self.select_pending_files('AND filename=?', (filename,))
+
+    def select_directory_data(self, directory):
+        return self.select_pending_files('AND filename LIKE ?', (directory + '%',))
+
+    def select_files_without_audio_language(self, language='rus'):
+        """
+        Select files which have no audio track in given language
+
+        Parameters
+        ----------
+        language : str
+            language tag of audio track
+
+        Returns
+        -------
+        list of tuple
+            (id, filename) of files
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute("""SELECT id, filename FROM Files
+                               WHERE NOT EXISTS (SELECT 1 FROM Streams
+                                                 WHERE Streams.file_id=Files.id AND codec_type='audio' AND language=?)""", (language,))
+                return cur.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting data: {e}')
+
+    def select_files_by_audio_tracks(self, min_tracks):
+        """
+        Select files which have at least `min_tracks` audio tracks
+
+        Parameters
+        ----------
+        min_tracks : int
+            minimal number of audio tracks
+
+        Returns
+        -------
+        list of tuple
+            (id, filename, number of audio tracks) of files
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute("""SELECT Files.id, Files.filename, audio.tracks
+                               FROM (SELECT file_id, count(*) AS tracks FROM Streams
+                                     WHERE codec_type='audio' GROUP BY file_id HAVING count(*) >= ?) AS audio
+                               JOIN Files ON Files.id=audio.file_id""", (min_tracks,))
+                return cur.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting data: {e}')
+    
+    def enqueue_jobs(self, condition='', params=()):
+        """
+        Queue conversion jobs for files which need conversion and are not converted yet.
+        Files already queued or running are left as they are, failed and skipped jobs are queued again.
+        Jobs which are 'done' are never queued again, their file may still wait for the status writer to mark it converted.
+        Kind and media length of files are stored with the job, so that dispatch orders jobs by index.
+
+        Parameters
+        ----------
+        condition : str
+            additional sql condition on 'Files' table, starting with AND
+        params : tuple
+            parameters of `condition`
+
+        Returns
+        -------
+        int
+            number of queued jobs
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute(f"""INSERT INTO ConversionJobs (file_id, state, queued_at, is_film, media_seconds)
+                                SELECT id, 'queued', ?, coalesce(IsFilm, 0), {MEDIA_SECONDS} FROM Files WHERE needs_conversion AND NOT IsConverted {condition}
+                                ON CONFLICT(file_id) DO UPDATE SET state='queued', owner=NULL, lease_until=NULL, attempts=0, queued_at=excluded.queued_at,
+                                                                   is_film=excluded.is_film, media_seconds=excluded.media_seconds
+                                WHERE state IN ('failed', 'skipped')""", (time.time(), *params))
+                return cur.rowcount
+        except sqlite3.Error as e:
+            logger.error(f'Error queueing jobs: {e}')
+            return 0
+
+    def claim_job(self, owner, lease_seconds, condition='', params=(), max_attempts=3):
+        """
+        Atomically take the next queued job. Jobs of owners whose lease expired are queued again first,
+        or failed after `max_attempts` claims.
+
+        Parameters
+        ----------
+        owner : str
+            name of worker taking the job
+        lease_seconds : float
+            seconds the job belongs to worker unless lease is renewed
+        condition : str
+            additional sql condition on 'Files' table, starting with AND
+        params : tuple
+            parameters of `condition`
+        max_attempts : int
+            number of claims after which a job with expired lease is failed
+
+        Returns
+        -------
+        tuple or None
+            id, IsFilm, IsConverted, filename, needs_conversion, audio_index of file, None if queue is empty
+        """
+        now = time.time()
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute("""UPDATE ConversionJobs SET state=CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, owner=NULL, lease_until=NULL
+                               WHERE state='running' AND lease_until < ?""", (max_attempts, now))
+                if cur.rowcount > 0:
+                    logger.warning(f'Reclaimed {cur.rowcount} conversion jobs with expired lease')
+                cur.execute(f"""UPDATE ConversionJobs SET state='running', owner=?, lease_until=?, claimed_at=?, attempts=attempts + 1
+                                WHERE file_id = (SELECT ConversionJobs.file_id FROM ConversionJobs JOIN Files ON Files.id=ConversionJobs.file_id
+                                                 WHERE state='queued' {condition} ORDER BY ConversionJobs.file_id LIMIT 1)
+                                RETURNING file_id""", (owner, now + lease_seconds, now, *params))
+                row = cur.fetchone()
+                if row is None:
+                    return None
+                cur.execute('SELECT id, IsFilm, IsConverted, filename, needs_conversion, audio_index FROM Files WHERE id=?', row)
+                return cur.fetchone()
+        except sqlite3.Error as e:
+            logger.error(f'Error claiming job: {e}')
+            return None
+
+    def select_queued_jobs(self, limit, condition='', params=(), order='id', speeds=(1.0, 1.0), is_film=None):
+        """
+        Select queued jobs in the order they are dispatched to workers.
+        For 'lpt' and 'spt' films and serials are read by index in order of media length and merged by estimate.
+
+        Parameters
+        ----------
+        limit : int
+            number of selected jobs
+        condition : str
+            additional sql condition on 'Files' table, starting with AND
+        params : tuple
+            parameters of `condition`
+        order : str
+            key of JOB_ORDERS
+        speeds : tuple
+            (films, serials) seconds of conversion per second of media, see select_job_speeds
+        is_film : bool or None
+            select only films or only serials, None selects both
+
+        Returns
+        -------
+        list of tuple
+            (file_id, IsFilm, media_seconds, estimated seconds of conversion)
+        """
+        kinds = (True, False) if is_film is None and order != 'id' else (is_film,)
+        jobs = []
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                for kind in kinds:
+                    kind_condition, kind_params = ('', ()) if kind is None else (' AND ConversionJobs.is_film=?', (kind,))
+                    cur.execute(f"""SELECT ConversionJobs.file_id, ConversionJobs.is_film, coalesce(ConversionJobs.media_seconds, 0)
+                                    FROM ConversionJobs JOIN Files ON Files.id=ConversionJobs.file_id
+                                    WHERE state='queued'{kind_condition} {condition} ORDER BY {JOB_ORDERS[order]} LIMIT ?""", (*kind_params, *params, limit))
+                    jobs += [(file_id, film, media_seconds, media_seconds * speeds[0 if film else 1]) for file_id, film, media_seconds in cur.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting jobs: {e}')
+            return []
+        if order != 'id':
+            jobs.sort(key=lambda job: job[3], reverse=order == 'lpt')
+        return jobs[:limit]
+
+    def save_job_estimate(self, file_id, media_seconds, estimated_seconds):
+        """
+        Save estimate of a dispatched job, compared with its real duration when it is finished
+        """
+        try:
+            with self.transaction() as conn:
+                conn.execute('UPDATE ConversionJobs SET media_seconds=?, estimated_seconds=? WHERE file_id=?', (media_seconds, estimated_seconds, file_id))
+        except sqlite3.Error as e:
+            logger.error(f'Error saving job estimate: {e}')
+
+    def select_job_speeds(self, window):
+        """
+        Seconds of conversion per second of media of films and serials, measured on last converted jobs.
+        Skipped and failed jobs are left out, as are files not marked converted yet by the status writer.
+
+        Parameters
+        ----------
+        window : int
+            number of last finished jobs taken into account
+
+        Returns
+        -------
+        dict
+            {IsFilm: speed}, kinds without finished jobs are missing
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute("""SELECT IsFilm, sum(finished_at - claimed_at) / sum(media_seconds)
+                               FROM (SELECT coalesce(Files.IsFilm, 0) AS IsFilm, finished_at, claimed_at, media_seconds
+                                     FROM ConversionJobs JOIN Files ON Files.id=ConversionJobs.file_id
+                                     WHERE state='done' AND Files.IsConverted AND finished_at IS NOT NULL AND media_seconds > 0
+                                     ORDER BY finished_at DESC LIMIT ?)
+                               GROUP BY IsFilm""", (window,))
+                return {bool(is_film): speed for is_film, speed in cur.fetchall()}
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting job speeds: {e}')
+            return {}
 
-    def interrupted_program(self, current_time, file_id):
+    def select_estimate_error(self, window):
         """
-        Update ConversionTasks table with status 'Error: check logs' and current time if program is interrupted
-        
+        Error of estimates of last converted jobs, relative to their real duration
+
         Parameters
         ----------
-        current_time : str
-            current date and time in format '%Y-%m-%d %H:%M:%S'
-        file_id : int
-            id of file in database
+        window : int
+            number of last finished jobs taken into account
+
+        Returns
+        -------
+        tuple
+            (number of jobs, mean absolute error, mean signed error), positive error means jobs took longer than estimated
         """
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.transaction() as conn:
                 cur = conn.cursor()
-                cur.execute('UPDATE ConversionTasks SET status=?, end_time=? WHERE file_id=?', ('Conversion interrupted', current_time, file_id))  #update if program interrupted
-                conn.commit()
+                cur.execute("""SELECT count(*), avg(abs(actual - estimated_seconds) / actual), avg((actual - estimated_seconds) / actual)
+                               FROM (SELECT finished_at - claimed_at AS actual, estimated_seconds
+                                     FROM ConversionJobs JOIN Files ON Files.id=ConversionJobs.file_id
+                                     WHERE state='done' AND Files.IsConverted AND finished_at > claimed_at AND estimated_seconds IS NOT NULL
+                                     ORDER BY finished_at DESC LIMIT ?)""", (window,))
+                return cur.fetchone()
         except sqlite3.Error as e:
-            logger.error(f'Error updating data: {e}')
+            logger.error(f'Error selecting estimate error: {e}')
+            return 0, None, None
 
-    def select_data(self):
+    def count_queued_jobs(self, limit, condition='', params=()):
         """
-        Select data from database
+        Count queued jobs, counting stops at `limit` so that cost does not grow with the queue
+
+        Parameters
+        ----------
+        limit : int
+            greatest number counted
+        condition : str
+            additional sql condition on 'Files' table, starting with AND
+        params : tuple
+            parameters of `condition`
 
         Returns
         -------
-        list of tuples
-            list of files with their id, IsFilm, IsConverted, filename, nb_streams, streams
+        int
         """
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.transaction() as conn:
                 cur = conn.cursor()
-                cur.execute('SELECT id, IsFilm, IsConverted, filename, nb_streams, streams FROM Files')  #select data from database
-                return cur.fetchall()
+                cur.execute(f"""SELECT count(*) FROM (SELECT 1 FROM ConversionJobs JOIN Files ON Files.id=ConversionJobs.file_id
+                                                      WHERE state='queued' {condition} LIMIT ?)""", (*params, limit))
+                return cur.fetchone()[0]
         except sqlite3.Error as e:
-            logger.error(f'Error selecting data: {e}')
-        
-    def select_single_data(self, filename):
+            logger.error(f'Error counting jobs: {e}')
+            return 0
+
+    def renew_lease(self, file_id, owner, lease_seconds):
+        """
+        Extend lease of a running job
+
+        Parameters
+        ----------
+        file_id : int
+            id of file in database
+        owner : str
+            name of worker holding the job
+        lease_seconds : float
+            seconds from now until lease expires
+
+        Returns
+        -------
+        bool
+            True if worker still holds the job
+        """
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.transaction() as conn:
                 cur = conn.cursor()
-                cur.execute('SELECT id, IsFilm, IsConverted, filename, nb_streams, streams FROM Files WHERE filename=?', (filename,))  #select data from database
-                return cur.fetchall()
+                cur.execute("UPDATE ConversionJobs SET lease_until=? WHERE file_id=? AND owner=? AND state='running'", (time.time() + lease_seconds, file_id, owner))
+                return cur.rowcount == 1
         except sqlite3.Error as e:
-            logger.error(f'Error selecting data: {e}')
-    
-    def select_directory_data(self, directory):
+            logger.error(f'Error renewing lease: {e}')
+            return False
+
+    def finish_job(self, file_id, owner, state='done'):
+        """
+        Mark job of worker as finished, or put it back to queue with state 'queued'
+
+        Parameters
+        ----------
+        file_id : int
+            id of file in database
+        owner : str
+            name of worker holding the job
+        state : str
+            'done' if file was converted, 'failed', 'skipped' if file did not need conversion, or 'queued'
+
+        Returns
+        -------
+        bool
+            True if worker still held the job
+        """
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.transaction() as conn:
                 cur = conn.cursor()
-                cur.execute('SELECT id, IsFilm, IsConverted, filename, nb_streams, streams FROM Files WHERE filename LIKE ?', (directory + '%',))  #select data from database
-                return cur.fetchall()
+                cur.execute("UPDATE ConversionJobs SET state=?, owner=NULL, lease_until=NULL, finished_at=? WHERE file_id=? AND owner=? AND state='running'", (state, time.time(), file_id, owner))
+                return cur.rowcount == 1
         except sqlite3.Error as e:
-            logger.error(f'Error selecting data: {e}')
-    
+            logger.error(f'Error finishing job: {e}')
+            return False
+
     def update_status_of_conversion(self, file_id, status, current_time):
         """
         Update ConversionTasks table with status and current time of start of conversion
@@ -208,12 +1416,17 @@ class Db_query():
             status of conversion
         current_time : str
             current date and time in format '%Y-%m-%d %H:%M:%S'
+
+        Returns
+        -------
+        int or None
+            id of conversion attempt in ConversionTasks table, used for its later updates
         """
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.transaction() as conn:
                 cur = conn.cursor()
                 cur.execute('INSERT INTO ConversionTasks (file_id, status, start_time) VALUES (?, ?, ?)', (file_id, status, current_time))  #update status of conversion
-                conn.commit()
+                return cur.lastrowid
         except sqlite3.Error as e:
             logger.error(f'Error updating data: {e}')
 
@@ -229,10 +1442,9 @@ class Db_query():
             status of conversion
         """
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.transaction() as conn:
                 cur = conn.cursor()
                 cur.execute('INSERT INTO ConversionTasks (file_id, status, start_time, end_time) VALUES (?, ?, ?, ?)', (file_id, status, start_time, end_time))  #update status of conversion
-                conn.commit()
         except sqlite3.Error as e:
             logger.error(f'Error updating data: {e}')
     
@@ -248,14 +1460,13 @@ class Db_query():
             status of conversion
         """
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.transaction() as conn:
                 cur = conn.cursor()
                 cur.execute('UPDATE Files SET IsConverted=? WHERE id=?', (is_converted, file_id))
-                conn.commit()
         except sqlite3.Error as e:
             logger.error(f'Error updating data: {e}')
     
-    def update_status_ending_conversion(self, status, current_time, check_result, file_id):
+    def update_status_ending_conversion(self, status, current_time, check_result, task_id):
         """
         Update ConversionTasks table with status, current time of end of conversion and result of integrity check
         
@@ -267,18 +1478,17 @@ class Db_query():
             current date and time in format '%Y-%m-%d %H:%M:%S'
         check_result : str
             result of integrity check
-        file_id : int
-            id of file in database
+        task_id : int
+            id of conversion attempt returned by `update_status_of_conversion`
         """
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.transaction() as conn:
                 cur = conn.cursor()
-                cur.execute('UPDATE ConversionTasks SET status=?, end_time=?, check_integrity=? WHERE file_id=?', (status, current_time, check_result, file_id))  #update status of conversion
-                conn.commit()
+                cur.execute('UPDATE ConversionTasks SET status=?, end_time=?, check_integrity=? WHERE id=?', (status, current_time, check_result, task_id))  #update status of conversion
         except sqlite3.Error as e:
             logger.error(f'Error updating data: {e}')
         
-    def update_files_table(self, output_file, is_conveted, nb_streams, size, bitrate, streams, file_id):
+    def update_files_table(self, output_file, is_conveted, data, streams, file_id):
         """
         Update table 'Files' with new data
         
@@ -288,26 +1498,60 @@ class Db_query():
             path to output file
         is_conveted : bool
             flag to check if file is converted
-        nb_streams : int
-            number of streams in file
-        size : int
-            size of file in bytes
-        bitrate : int
-            bitrate of file
-        streams : str
-            json string of streams of file
+        data : ProbeRecord
+            data of output file, returned by ffprobe
+        streams : list of dict
+            list of streams of output file
         file_id : int
             id of file in database
         """
         try:
-            with sqlite3.connect(self.db_file) as conn:
-                cur = conn.cursor()
-                cur.execute('UPDATE Files SET filename=?, IsConverted=?, nb_streams=?, size=?, bit_rate=?, streams=? WHERE id=?', (output_file, is_conveted, nb_streams, size, bitrate, streams, file_id))  #update table 'Files' with new data  #update status of conversion
-                conn.commit()
+            with self.transaction() as conn:
+                self._update_files_row(conn.cursor(), output_file, is_conveted, data, streams, file_id)
         except sqlite3.Error as e:
             logger.error(f'Error updating data: {e}')
+
+    def save_converted_file(self, filename, output_file, data, streams, file_id):
+        """
+        Update table 'Files' with converted file and queue update of its url in one transaction,
+        committed before the call returns, so the original file may be removed afterwards
+
+        Parameters
+        ----------
+        filename : str
+            original filename
+        output_file : str
+            path to converted file
+        data : ProbeRecord
+            data of converted file, returned by ffprobe
+        streams : list of dict
+            list of streams of converted file
+        file_id : int
+            id of file in database
+
+        Returns
+        -------
+        bool
+            True if both updates were committed
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                self._update_files_row(cur, output_file, True, data, streams, file_id)
+                self._queue_url_update(cur, filename, output_file, file_id)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f'Error saving converted file {output_file}: {e}')
+            return False
+
+    def _update_files_row(self, cur, output_file, is_conveted, data, streams, file_id):
+        cur.execute('UPDATE Files SET filename=?, IsConverted=?, nb_streams=?, size=?, bit_rate=?, duration=?, streams=NULL, audio_index=?, video_codec=?, needs_conversion=? WHERE id=?',
+                    (output_file, is_conveted, len(streams), data.size, data.bit_rate, data.duration, *self.conversion_plan(data, streams), file_id))  #update table 'Files' with new data
+        cur.execute('DELETE FROM Streams WHERE file_id=?', (file_id,))
+        cur.executemany('INSERT INTO Streams (file_id, stream_index, codec_type, codec_name, language, is_default, title) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        [(file_id, *row) for row in stream_rows(data)])  #streams of converted file replace streams of source
     
-    def update_of_checking_integrity(self, status, current_time, check_result, file_id):
+    def update_of_checking_integrity(self, status, current_time, check_result, task_id):
         """
         Update ConversionTasks table with status, current time of end of checking and result of integrity check
         
@@ -319,20 +1563,21 @@ class Db_query():
             current date and time in format '%Y-%m-%d %H:%M:%S'
         check_result : str
             result of integrity check
-        file_id : int
-            id of file in database
+        task_id : int
+            id of conversion attempt returned by `update_status_of_conversion`
         """
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.transaction() as conn:
                 cur = conn.cursor()
-                cur.execute('UPDATE ConversionTasks SET status=?, end_time=?, check_integrity=? WHERE file_id=?', (status, current_time, check_result, file_id))  #update status of checking
-                conn.commit()
+                cur.execute('UPDATE ConversionTasks SET status=?, end_time=?, check_integrity=? WHERE id=?', (status, current_time, check_result, task_id))  #update status of checking
         except sqlite3.Error as e:
             logger.error(f'Error updating data: {e}')
     
-    def update_url_file(self, filename, output_file):
+    def update_url_file(self, filename, output_file, file_id=None):
         """
-        Update url in video_series_files table in maria database
+        Queue update of url in video_series_files table in maria database.
+        The update is saved to 'PortalOutbox' table and applied later by OutboxFlusher,
+        so conversion does not wait for maria database.
         
         Parameters
         ----------
@@ -340,30 +1585,345 @@ class Db_query():
             original filename
         output_file : str
             new filename
+        file_id : int or None
+            id of file in database, its rows in video_series_files are found in 'PortalFiles' table
+        """
+        try:
+            with self.transaction() as conn:
+                self._queue_url_update(conn.cursor(), filename, output_file, file_id)
+        except sqlite3.Error as e:
+            logger.error(f'Error inserting data: {e}')
+
+    def _queue_url_update(self, cur, filename, output_file, file_id):
+        now = time.time()
+        cur.execute('INSERT INTO PortalOutbox (file_id, filename, output_file, created_at, next_attempt) VALUES (?, ?, ?, ?, ?)', (file_id, filename, output_file, now, now))
+
+    def select_outbox_batch(self, limit, now):
+        """
+        Select url updates which are due to be applied, oldest first. Dead updates are never selected
+
+        Parameters
+        ----------
+        limit : int
+            maximal number of updates
+        now : float
+            current unix time
+
+        Returns
+        -------
+        list of tuple
+            (id, file_id, filename, output_file, attempts) of updates
         """
         try:
-            with mariadb.connect(
-                host = self.config['maria_db']['host'],
-                user = self.config['maria_db']['user'],
-                password = self.config['maria_db']['password'],
-                database = self.config['maria_db']['database'],
-                port = self.config['maria_db']['port']
-            ) as conn:
+            with self.transaction() as conn:
                 cur = conn.cursor()
-                cur.execute(
-                'UPDATE video_series_files SET url = REPLACE(url, ?, ?) WHERE url LIKE ?',
-                (filename, output_file, '%' + filename)
-            )
-                conn.commit() 
-        except mariadb.Error as e:
+                cur.execute('SELECT id, file_id, filename, output_file, attempts FROM PortalOutbox WHERE next_attempt <= ? AND NOT dead ORDER BY id LIMIT ?', (now, limit))
+                return cur.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting data: {e}')
+            return []
+
+    def delete_outbox_rows(self, ids):
+        """
+        Remove applied url updates from 'PortalOutbox' table
+
+        Parameters
+        ----------
+        ids : list of int
+            ids of updates
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.executemany('DELETE FROM PortalOutbox WHERE id=?', [(outbox_id,) for outbox_id in ids])
+        except sqlite3.Error as e:
+            logger.error(f'Error deleting data: {e}')
+
+    def postpone_outbox_rows(self, ids, error, now, retry_base, retry_max):
+        """
+        Schedule failed url updates for retry with exponential backoff
+
+        Parameters
+        ----------
+        ids : list of int
+            ids of updates
+        error : str
+            error of last attempt
+        now : float
+            current unix time
+        retry_base : float
+            delay in seconds after first failed attempt, doubled after every next one
+        retry_max : float
+            maximal delay in seconds
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.executemany('UPDATE PortalOutbox SET attempts=attempts + 1, last_error=?, next_attempt=? + min(?, ? * (1 << min(attempts, 30))) WHERE id=?',
+                                [(error, now, retry_max, retry_base, outbox_id) for outbox_id in ids])
+        except sqlite3.Error as e:
             logger.error(f'Error updating data: {e}')
 
-    def global_interrupted_query(self, current_time):
+    def kill_outbox_rows(self, failures):
+        """
+        Mark url updates which fail on their own as dead, they stay in 'PortalOutbox' table
+        for inspection but are not applied again
+
+        Parameters
+        ----------
+        failures : list of tuple
+            (id, error) of updates
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.executemany('UPDATE PortalOutbox SET attempts=attempts + 1, last_error=?, next_attempt=NULL, dead=1 WHERE id=?',  # NULL keeps them out of next_attempt index range
+                                [(error, outbox_id) for outbox_id, error in failures])
+        except sqlite3.Error as e:
+            logger.error(f'Error updating data: {e}')
+
+    def outbox_backlog(self):
+        """
+        Get size of backlog of url updates
+
+        Returns
+        -------
+        tuple
+            (number of updates, unix time when oldest update was queued or None, number of dead updates)
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT count(*) - coalesce(sum(dead), 0), min(CASE WHEN NOT dead THEN created_at END), coalesce(sum(dead), 0) FROM PortalOutbox')
+                return cur.fetchone()
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting data: {e}')
+            return 0, None, 0
+
+    def apply_url_updates(self, conn, updates):
+        """
+        Update urls in video_series_files table in maria database in one transaction.
+        Rows of files with known portal ids are updated by primary key in one statement,
+        other files fall back to a suffix match on url.
+
+        Parameters
+        ----------
+        conn : mariadb.Connection
+            connection to maria database
+        updates : list of tuple
+            (filename, output_file, portal_ids) where portal_ids is a list of ids in video_series_files
+            or empty if they are not known
+
+        Raises
+        ------
+        mariadb.Error
+            if updates can not be applied, nothing is committed then
+        """
+        by_id = [(portal_id, filename, output_file) for filename, output_file, portal_ids in updates for portal_id in portal_ids]
+        by_url = [(filename, output_file, '%' + filename) for filename, output_file, portal_ids in updates if not portal_ids]
+        cur = conn.cursor()
+        try:
+            if by_id:
+                cases = ' '.join('WHEN ? THEN REPLACE(url, ?, ?)' for _ in by_id)
+                cur.execute(
+                    f'UPDATE video_series_files SET url = CASE id {cases} ELSE url END WHERE id IN ({", ".join("?" * len(by_id))})',
+                    (*(value for row in by_id for value in row), *(row[0] for row in by_id))
+                )
+            if by_url:
+                cur.executemany('UPDATE video_series_files SET url = REPLACE(url, ?, ?) WHERE url LIKE ?', by_url)
+            conn.commit()
+        except mariadb.Error:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+    def select_portal_ids(self, file_ids):
+        """
+        Get ids of rows in video_series_files mapped to files
+
+        Parameters
+        ----------
+        file_ids : list of int
+            ids of files in database
+
+        Returns
+        -------
+        dict
+            file_id -> list of ids in video_series_files, files without mapping are missing
+        """
+        portal_ids = {}
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                file_ids = [file_id for file_id in set(file_ids) if file_id is not None]
+                for start in range(0, len(file_ids), 500):
+                    chunk = file_ids[start:start + 500]
+                    cur.execute(f'SELECT file_id, portal_id FROM PortalFiles WHERE file_id IN ({", ".join("?" * len(chunk))})', chunk)
+                    for file_id, portal_id in cur.fetchall():
+                        portal_ids.setdefault(file_id, []).append(portal_id)
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting data: {e}')
+        return portal_ids
+
+    def match_portal_urls(self, urls):
+        """
+        Find files whose filename is a suffix of urls of video_series_files, as `url LIKE '%' || filename` does.
+        Only suffixes starting at '/' are looked up, in the unique index on filename.
+
+        Parameters
+        ----------
+        urls : list of tuple
+            (portal_id, url) rows of video_series_files
+
+        Returns
+        -------
+        list of tuple
+            (file_id, portal_id) pairs
+        """
+        suffixes = {}
+        for portal_id, url in urls:
+            position = (url or '').find('/')
+            while position != -1:
+                suffixes.setdefault(url[position:], []).append(portal_id)
+                position = url.find('/', position + 1)
+
+        pairs = []
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                names = list(suffixes)
+                for start in range(0, len(names), 500):
+                    chunk = names[start:start + 500]
+                    cur.execute(f'SELECT id, filename FROM Files WHERE filename IN ({", ".join("?" * len(chunk))})', chunk)
+                    pairs.extend((file_id, portal_id) for file_id, filename in cur.fetchall() for portal_id in suffixes[filename])
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting data: {e}')
+        return pairs
+
+    def save_portal_mapping(self, pairs):
+        """
+        Save mapping of files to rows of video_series_files
+
+        Parameters
+        ----------
+        pairs : list of tuple
+            (file_id, portal_id) pairs
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.executemany('INSERT OR IGNORE INTO PortalFiles (file_id, portal_id) VALUES (?, ?)', pairs)
+        except sqlite3.Error as e:
+            logger.error(f'Error inserting data: {e}')
+
+    def select_unmapped_files(self, after_id, limit):
+        """
+        Select files without rows in 'PortalFiles' table
+
+        Parameters
+        ----------
+        after_id : int
+            only files with greater id are selected
+        limit : int
+            maximal number of files
+
+        Returns
+        -------
+        list of tuple
+            (id, filename) of files ordered by id
+        """
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.transaction() as conn:
                 cur = conn.cursor()
-                cur.execute('UPDATE ConversionTasks SET status=?, end_time=? WHERE status="converting"', ('Conversion interrupted', current_time)) 
+                cur.execute("""SELECT id, filename FROM Files
+                               WHERE id > ? AND NOT EXISTS (SELECT 1 FROM PortalFiles WHERE PortalFiles.file_id=Files.id)
+                               ORDER BY id LIMIT ?""", (after_id, limit))
                 return cur.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting data: {e}')
+            return []
+
+    def max_file_id(self):
+        """
+        Get greatest id in 'Files' table
+
+        Returns
+        -------
+        int
+            greatest id or 0 if table is empty
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT coalesce(max(id), 0) FROM Files')
+                return cur.fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting data: {e}')
+            return 0
+
+    def get_portal_sync_state(self, name, default=0):
+        """
+        Get value saved by portal sync, e.g. greatest id of video_series_files already matched
+
+        Parameters
+        ----------
+        name : str
+            name of value
+        default : int
+            value returned if nothing is saved
+
+        Returns
+        -------
+        int
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT value FROM PortalSyncState WHERE name=?', (name,))
+                row = cur.fetchone()
+                return row[0] if row else default
+        except sqlite3.Error as e:
+            logger.error(f'Error selecting data: {e}')
+            return default
+
+    def save_portal_sync_state(self, name, value):
+        """
+        Save value of portal sync
+
+        Parameters
+        ----------
+        name : str
+            name of value
+        value : int
+            value
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute('INSERT OR REPLACE INTO PortalSyncState (name, value) VALUES (?, ?)', (name, value))
+        except sqlite3.Error as e:
+            logger.error(f'Error inserting data: {e}')
+
+    def global_interrupted_query(self, current_time):
+        """
+        Mark all conversions in progress as interrupted
+
+        Parameters
+        ----------
+        current_time : str
+            current date and time in format '%Y-%m-%d %H:%M:%S'
+
+        Returns
+        -------
+        int
+            number of interrupted conversions
+        """
+        try:
+            with self.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute('UPDATE ConversionTasks SET status=?, end_time=? WHERE status=?', ('Conversion interrupted', current_time, 'converting'))
+                return cur.rowcount
         except sqlite3.Error as e:
             logger.error(f'Error updating data: {e}')
 
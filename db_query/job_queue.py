@@ -0,0 +1,87 @@
+import os
+import socket
+import threading
+
+from custom_logging.logger import CustomLogger
+
+custom_logger = CustomLogger(log_dir="logs", max_files=30, rotation_interval=30)
+logger = custom_logger.get_logger()
+
+def job_owner():
+    """Name of current worker process in 'ConversionJobs' table"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+class JobLease:
+    '''Class for keeping lease of a claimed job alive while it is converted'''
+    def __init__(self, db_file, file_id, owner, lease_seconds):
+        """
+        Initialize class variables
+
+        Parameters
+        ----------
+        db_file : Db_query
+            instance of Db_query class
+        file_id : int
+            id of file of claimed job
+        owner : str
+            name of worker holding the job
+        lease_seconds : float
+            length of lease, it is renewed every third of it
+
+        Attributes
+        ----------
+        lost : bool
+            True once renewal found that the job belongs to another worker
+        """
+        self.db_file = db_file
+        self.file_id = file_id
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        '''
+        Renew lease every third of `lease_seconds` in a background thread
+        '''
+        self._thread = threading.Thread(target=self._run, name=f'lease-{self.file_id}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stop renewing lease
+        '''
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def held(self):
+        '''
+        Renew lease now, to be called right before the result of the job is made visible
+
+        Returns
+        -------
+        bool
+            True if worker still holds the job
+        '''
+        if not self.lost and not self.db_file.renew_lease(self.file_id, self.owner, self.lease_seconds):
+            self.lost = True
+        return not self.lost
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            if not self.held():
+                logger.error(f'Lease of job {self.file_id} lost by {self.owner}')
+                return
+
+# if __name__ == '__main__':
+#     pass
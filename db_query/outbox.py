@@ -0,0 +1,253 @@
+import threading
+import time
+
+import mariadb
+
+from db_query.db_query import Db_query
+from custom_logging.logger import CustomLogger
+
+custom_logger = CustomLogger(log_dir="logs", max_files=30, rotation_interval=30)
+logger = custom_logger.get_logger()
+
+class OutboxFlusher:
+    '''Class for applying url updates queued in 'PortalOutbox' table to Stalker Portal database'''
+    def __init__(self, config, pool=None):
+        """
+        Initialize class variables
+
+        Parameters
+        ----------
+        config : dict
+            config dictionary
+        pool : mariadb.ConnectionPool or None
+            pool of connections to Stalker Portal database, made from 'maria_db' config
+            on first use if None. A given pool is not closed by the flusher
+
+        Attributes
+        ----------
+        config : dict
+            config dictionary
+        maria_db : dict
+            config of maria database
+        db_file : Db_query
+            instance of Db_query class
+        batch_size : int
+            number of updates applied in one maria transaction
+        pool_size : int
+            number of connections in maria connection pool
+        flush_interval : float
+            seconds between flushes of background thread
+        retry_base : float
+            delay in seconds after first failed attempt, doubled after every next one
+        retry_max : float
+            maximal delay in seconds between attempts
+        backlog_warning : int
+            backlog size at which a warning is logged
+        pool : mariadb.ConnectionPool or None
+            pool given to constructor
+        """
+        self.config = config
+        self.maria_db = config['maria_db']
+        self.db_file = Db_query(config)
+        self.batch_size = config.get('portal_batch_size', 100)
+        self.pool_size = config.get('portal_pool_size', 2)
+        self.flush_interval = config.get('portal_flush_interval', 5)
+        self.retry_base = config.get('portal_retry_base', 5)
+        self.retry_max = config.get('portal_retry_max', 600)
+        self.backlog_warning = config.get('portal_backlog_warning', 1000)
+        self.pool = pool
+        self._pool = None
+        self._thread = None
+        self._stop = None
+
+    def __getstate__(self):
+        # pool and thread live only in the process which started flusher
+        state = self.__dict__.copy()
+        state.update(_pool=None, _thread=None, _stop=None)
+        return state
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        '''
+        Flush outbox every `flush_interval` seconds in a background thread
+        '''
+        if self._thread is not None:
+            return
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='portal-outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stop background thread and make a last flush
+        '''
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self.close()
+
+    def close(self):
+        '''
+        Close maria connection pool
+        '''
+        if self._pool is not None and self._pool is not self.pool:
+            try:
+                self._pool.close()
+            except mariadb.Error as e:
+                logger.error(f'Error closing maria connection pool: {e}')
+            self._pool = None
+
+    def flush(self):
+        '''
+        Apply all due updates, stop at the first failed batch
+
+        Returns
+        -------
+        int
+            number of applied updates
+        '''
+        applied = 0
+        while True:
+            count, failed = self.flush_batch()
+            applied += count
+            if failed or count < self.batch_size:
+                break
+        self.report_backlog()
+        return applied
+
+    def flush_batch(self):
+        '''
+        Apply one batch of due updates in one maria transaction. If the batch fails,
+        its updates are applied one by one, see `apply_rows`. If maria can not be
+        reached or connection is lost, updates are postponed with exponential backoff
+        and the pool is recreated on next attempt.
+
+        Returns
+        -------
+        tuple
+            (number of applied updates, True if batch failed)
+        '''
+        rows = self.db_file.select_outbox_batch(self.batch_size, time.time())
+        if not rows:
+            return 0, False
+        ids = [row[0] for row in rows]
+        portal_ids = self.db_file.select_portal_ids([row[1] for row in rows])  # mapped by sync_portal_ids.py
+        updates = [(filename, output_file, portal_ids.get(file_id, [])) for _, file_id, filename, output_file, _ in rows]
+        try:
+            conn = self._connection()
+        except mariadb.Error as e:
+            logger.error(f'Error connecting to Stalker Portal, {len(rows)} url updates retry later: {e}')
+            self.db_file.postpone_outbox_rows(ids, str(e), time.time(), self.retry_base, self.retry_max)
+            self.close()
+            return 0, True
+        with conn:
+            try:
+                self.db_file.apply_url_updates(conn, updates)
+                applied, failed = ids, False
+            except mariadb.Error as e:
+                logger.warning(f'Error updating {len(rows)} urls on Stalker Portal, applying them one by one: {e}')
+                applied, failed = self.apply_rows(conn, ids, updates)
+        self.db_file.delete_outbox_rows(applied)
+        if failed:
+            self.close()
+        return len(applied), failed
+
+    def apply_rows(self, conn, ids, updates):
+        '''
+        Apply updates of a failed batch one by one, each in its own maria transaction.
+        An update whose own statement fails while the connection is alive is marked dead,
+        so that it does not block the outbox. When the connection is lost, the update and
+        all after it are postponed with exponential backoff.
+
+        Parameters
+        ----------
+        conn : mariadb.Connection
+            connection to maria database
+        ids : list of int
+            ids of updates in 'PortalOutbox' table
+        updates : list of tuple
+            updates as accepted by Db_query.apply_url_updates
+
+        Returns
+        -------
+        tuple
+            (ids of applied updates, True if connection was lost)
+        '''
+        applied = []
+        failures = []
+        lost = False
+        for index, (outbox_id, update) in enumerate(zip(ids, updates)):
+            try:
+                self.db_file.apply_url_updates(conn, [update])
+                applied.append(outbox_id)
+            except mariadb.Error as e:
+                if not self._alive(conn):
+                    logger.error(f'Connection to Stalker Portal lost, {len(ids) - index} url updates retry later: {e}')
+                    self.db_file.postpone_outbox_rows(ids[index:], str(e), time.time(), self.retry_base, self.retry_max)
+                    lost = True
+                    break
+                logger.error(f'Url update {outbox_id} failed on Stalker Portal, marked dead: {e}')
+                failures.append((outbox_id, str(e)))
+        if failures:
+            self.db_file.kill_outbox_rows(failures)
+        return applied, lost
+
+    def report_backlog(self):
+        '''
+        Log size and age of outbox backlog and number of dead updates
+
+        Returns
+        -------
+        tuple
+            (number of queued updates, age of oldest update in seconds or None)
+        '''
+        count, oldest, dead = self.db_file.outbox_backlog()
+        if dead:
+            logger.warning(f'Stalker Portal outbox holds {dead} dead updates, see last_error in PortalOutbox table')
+        age = time.time() - oldest if oldest is not None else None
+        if count >= self.backlog_warning:
+            logger.warning(f'Stalker Portal outbox backlog: {count} updates, oldest queued {age:.0f} seconds ago')
+        elif count:
+            logger.info(f'Stalker Portal outbox backlog: {count} updates, oldest queued {age:.0f} seconds ago')
+        return count, age
+
+    def _connection(self):
+        if self._pool is None and self.pool is not None:
+            self._pool = self.pool
+        if self._pool is None:
+            self._pool = mariadb.ConnectionPool(
+                pool_name = 'portal_outbox',
+                pool_size = self.pool_size,
+                host = self.maria_db['host'],
+                user = self.maria_db['user'],
+                password = self.maria_db['password'],
+                database = self.maria_db['database'],
+                port = self.maria_db['port']
+            )
+        return self._pool.get_connection()
+
+    def _alive(self, conn):
+        # failed statement on a live connection is an error of the update itself
+        try:
+            conn.ping()
+            return True
+        except mariadb.Error:
+            return False
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f'Error flushing Stalker Portal outbox: {e}')
+
+# if __name__ == '__main__':
+#     pass
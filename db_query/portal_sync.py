@@ -0,0 +1,114 @@
+import mariadb
+
+from db_query.db_query import Db_query
+from custom_logging.logger import CustomLogger
+
+custom_logger = CustomLogger(log_dir="logs", max_files=30, rotation_interval=30)
+logger = custom_logger.get_logger()
+
+class PortalSync:
+    '''Class for mapping files in database to rows of video_series_files table on Stalker Portal'''
+    def __init__(self, config):
+        """
+        Initialize class variables
+
+        Parameters
+        ----------
+        config : dict
+            config dictionary
+
+        Attributes
+        ----------
+        config : dict
+            config dictionary
+        maria_db : dict
+            config of maria database
+        db_file : Db_query
+            instance of Db_query class
+        page_size : int
+            number of rows of video_series_files read at once
+        like_batch : int
+            number of new files looked up by url in one query
+        """
+        self.config = config
+        self.maria_db = config['maria_db']
+        self.db_file = Db_query(config)
+        self.page_size = config.get('portal_sync_page_size', 1000)
+        self.like_batch = config.get('portal_sync_like_batch', 100)
+
+    def sync(self, full=False):
+        '''
+        Map files to rows of video_series_files and save mapping to 'PortalFiles' table.
+
+        Rows of video_series_files added since last sync are read by primary key and matched
+        to all files, files added since last sync are looked up by url in batches.
+        Full sync reads the whole table once. Progress is saved after every page.
+
+        Parameters
+        ----------
+        full : bool
+            read whole video_series_files table instead of rows added since last sync
+
+        Returns
+        -------
+        int
+            number of found (file, row) pairs
+        '''
+        matched = 0
+        try:
+            with mariadb.connect(
+                host = self.maria_db['host'],
+                user = self.maria_db['user'],
+                password = self.maria_db['password'],
+                database = self.maria_db['database'],
+                port = self.maria_db['port']
+            ) as conn:
+                cur = conn.cursor()
+                last_file_id = self.db_file.max_file_id()
+                if not full:
+                    matched += self.sync_new_files(cur, last_file_id)
+                matched += self.sync_new_rows(cur, 0 if full else self.db_file.get_portal_sync_state('last_portal_id'))
+                self.db_file.save_portal_sync_state('last_file_id', last_file_id)
+        except mariadb.Error as e:
+            logger.error(f'Error syncing Stalker Portal ids: {e}')
+        logger.info(f'Stalker Portal sync mapped {matched} urls')
+        return matched
+
+    def sync_new_rows(self, cur, last_portal_id):
+        '''
+        Match rows of video_series_files with id greater than `last_portal_id`
+        '''
+        matched = 0
+        while True:
+            cur.execute('SELECT id, url FROM video_series_files WHERE id > ? ORDER BY id LIMIT ?', (last_portal_id, self.page_size))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            pairs = self.db_file.match_portal_urls(rows)
+            self.db_file.save_portal_mapping(pairs)
+            matched += len(pairs)
+            last_portal_id = rows[-1][0]
+            self.db_file.save_portal_sync_state('last_portal_id', last_portal_id)
+        return matched
+
+    def sync_new_files(self, cur, max_file_id):
+        '''
+        Look up files added since last sync, which have no mapping yet, by url.
+        Rows of files which appear on portal later are found by `sync_new_rows`.
+        '''
+        matched = 0
+        after_id = self.db_file.get_portal_sync_state('last_file_id')
+        while True:
+            files = [row for row in self.db_file.select_unmapped_files(after_id, self.like_batch) if row[0] <= max_file_id]
+            if not files:
+                break
+            cur.execute(f'SELECT id, url FROM video_series_files WHERE {" OR ".join("url LIKE ?" for _ in files)}',
+                        ['%' + filename for _, filename in files])
+            pairs = self.db_file.match_portal_urls(cur.fetchall())
+            self.db_file.save_portal_mapping(pairs)
+            matched += len(pairs)
+            after_id = files[-1][0]
+        return matched
+
+# if __name__ == '__main__':
+#     pass
@@ -0,0 +1,287 @@
+import itertools
+import multiprocessing
+from multiprocessing.connection import Client, Listener, arbitrary_address, wait
+import os
+import signal
+import threading
+import time
+
+from db_query.db_query import Db_query
+from custom_logging.logger import CustomLogger
+
+custom_logger = CustomLogger(log_dir="logs", max_files=30, rotation_interval=30)
+logger = custom_logger.get_logger()
+
+# address of the running writer process, inherited by pool workers through fork
+_writer_state = {'process': None, 'address': None, 'authkey': None}
+# connection of current process to writer, every process has its own so a killed worker
+# can neither leave a lock held nor a partial message in the channel of others
+_connection_state = {'pid': None, 'connection': None, 'lock': None}
+# keys of conversion attempts started in this process, combined with pid to be unique
+_task_keys = itertools.count(1)
+
+# methods whose last argument is id of conversion attempt in ConversionTasks table
+TASK_METHODS = ('update_status_ending_conversion', 'update_of_checking_integrity', 'interrupted_program')
+# methods ending a conversion attempt, key of the attempt is forgotten after them
+ENDING_METHODS = ('finish_job',)
+
+class StatusWriter:
+    '''Class for writing conversion bookkeeping of all workers from one process in grouped transactions'''
+    def __init__(self, config):
+        """
+        Initialize class variables
+
+        Parameters
+        ----------
+        config : dict
+            config dictionary
+
+        Attributes
+        ----------
+        config : dict
+            config dictionary
+        flush_interval : float
+            seconds a received update may wait before it is committed, the durability bound
+        batch_size : int
+            number of updates committed in one transaction at most
+        stop_timeout : float
+            seconds `stop` waits for writer process before it is terminated
+        db_file : Db_query
+            instance of Db_query class, used directly when writer is not running
+        """
+        self.config = config
+        self.flush_interval = config.get('status_flush_interval', 1)
+        self.batch_size = config.get('status_batch_size', 200)
+        self.stop_timeout = config.get('status_stop_timeout', 30)
+        self.db_file = Db_query(config)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        '''
+        Start writer process. Processes forked afterwards send their updates to it.
+        '''
+        if _writer_state['process'] is not None:
+            return
+        address, authkey, ready = arbitrary_address('AF_UNIX'), os.urandom(16), multiprocessing.Event()
+        process = multiprocessing.Process(target=self._run, args=(address, authkey, ready), name='status-writer', daemon=True)
+        process.start()
+        if not ready.wait(self.stop_timeout):
+            process.terminate()
+            raise RuntimeError('Status writer process did not start')
+        _writer_state.update(process=process, address=address, authkey=authkey)
+
+    def stop(self):
+        '''
+        Commit all received updates and stop writer process, it is terminated if it does not stop in `stop_timeout` seconds
+        '''
+        process = _writer_state['process']
+        if process is None:
+            return
+        self._send(None)
+        process.join(self.stop_timeout)
+        if process.is_alive():
+            logger.error(f'Status writer did not stop in {self.stop_timeout} seconds, terminated')
+            process.terminate()
+            process.join()
+        if _connection_state['connection'] is not None:
+            _connection_state['connection'].close()
+        _writer_state.update(process=None, address=None, authkey=None)
+        _connection_state.update(pid=None, connection=None, lock=None)
+
+    def _send(self, message):
+        # updates are written to the socket before the call returns, so they survive a killed worker
+        if _connection_state['pid'] != os.getpid():
+            _connection_state.update(pid=os.getpid(), connection=None, lock=threading.Lock())
+        with _connection_state['lock']:  # only threads of this process share the connection
+            try:
+                if _connection_state['connection'] is None:
+                    _connection_state['connection'] = Client(_writer_state['address'], authkey=_writer_state['authkey'])
+                _connection_state['connection'].send(message)
+                return True
+            except Exception as e:
+                logger.error(f'Error sending status update to writer process: {e}')
+                _connection_state['connection'] = None
+                return False
+
+    def apply(self, method, *args, key=None):
+        '''
+        Send update to writer process, or apply it at once if writer is not running
+        or can not be reached
+
+        Parameters
+        ----------
+        method : str
+            name of Db_query method
+        args : tuple
+            arguments of method
+        key : str or None
+            key of conversion attempt started by this update, or ended by it for ENDING_METHODS
+
+        Returns
+        -------
+        any
+            result of Db_query method if it was applied at once, else None
+        '''
+        if _writer_state['process'] is None or not self._send((method, args, key)):
+            return getattr(self.db_file, method)(*args)
+
+    def update_status_of_conversion(self, file_id, status, current_time):
+        '''
+        Start conversion attempt, see Db_query.update_status_of_conversion
+
+        Returns
+        -------
+        int or str
+            id of attempt in ConversionTasks table, or key standing for it when writer is running
+        '''
+        if _writer_state['process'] is None:
+            return self.db_file.update_status_of_conversion(file_id, status, current_time)
+        key = f'{os.getpid()}:{next(_task_keys)}'
+        if not self._send(('update_status_of_conversion', (file_id, status, current_time), key)):
+            return self.db_file.update_status_of_conversion(file_id, status, current_time)
+        return key
+
+    def update_status_first_check(self, file_id, status, start_time, end_time):
+        self.apply('update_status_first_check', file_id, status, start_time, end_time)
+
+    def update_isconverted_after_fail_check(self, file_id, is_converted):
+        self.apply('update_isconverted_after_fail_check', file_id, is_converted)
+
+    def update_status_ending_conversion(self, status, current_time, check_result, task_id):
+        self.apply('update_status_ending_conversion', status, current_time, check_result, task_id)
+
+    def update_files_table(self, output_file, is_conveted, data, streams, file_id):
+        self.apply('update_files_table', output_file, is_conveted, data, streams, file_id)
+
+    def save_converted_file(self, filename, output_file, data, streams, file_id):
+        '''
+        Save converted file and queue update of its url, see Db_query.save_converted_file.
+        Written directly instead of through writer process, the original file is removed
+        only after this is committed.
+
+        Returns
+        -------
+        bool
+            True if updates were committed
+        '''
+        return self.db_file.save_converted_file(filename, output_file, data, streams, file_id)
+
+    def update_of_checking_integrity(self, status, current_time, check_result, task_id):
+        self.apply('update_of_checking_integrity', status, current_time, check_result, task_id)
+
+    def invalidate_probe_cache(self, path=None):
+        self.apply('invalidate_probe_cache', path)
+
+    def update_url_file(self, filename, output_file, file_id=None):
+        self.apply('update_url_file', filename, output_file, file_id)
+
+    def interrupted_program(self, current_time, task_id):
+        self.apply('interrupted_program', current_time, task_id)
+
+    def finish_job(self, file_id, owner, state='done', task_id=None):
+        '''
+        Finish job after the updates of its conversion, see Db_query.finish_job.
+        `task_id` of the conversion attempt is no longer needed by the writer after it.
+        '''
+        self.apply('finish_job', file_id, owner, state, key=task_id)
+
+    def _run(self, address, authkey, ready):
+        '''
+        Receive updates and commit them in transactions of at most `batch_size` updates,
+        no update waits longer than `flush_interval` seconds
+        '''
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # stopped by parent after workers, so last updates are kept
+        listener = Listener(address, 'AF_UNIX', authkey=authkey)
+        connections = []
+        accepted = threading.Lock()
+        threading.Thread(target=self._accept, args=(listener, connections, accepted), name='status-accept', daemon=True).start()
+        ready.set()
+        db_file = Db_query(self.config)
+        task_ids = {}  # key of attempt -> id in ConversionTasks
+        pending = []
+        deadline = None
+        running = True
+
+        while True:
+            with accepted:
+                current = list(connections)
+            if running:
+                # new connections are picked up at least every 0.2 seconds
+                timeout = 0.2 if not pending else min(0.2, max(0, deadline - time.monotonic()))
+            else:
+                timeout = 0  # stop was requested, read what is left and quit
+            received = False
+            for conn in wait(current, timeout):
+                try:
+                    message = conn.recv()
+                except EOFError:  # process closed its connection or exited
+                    message = False
+                except Exception as e:  # process killed in the middle of a message, only its channel is dropped
+                    logger.error(f'Error receiving status update, connection dropped: {e}')
+                    message = False
+                if message is False:
+                    with accepted:
+                        connections.remove(conn)
+                    conn.close()
+                elif message is None:
+                    running = False
+                else:
+                    received = True
+                    if not pending:
+                        deadline = time.monotonic() + self.flush_interval
+                    pending.append(message)
+
+            if pending and (not running or len(pending) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(db_file, pending, task_ids)
+                pending = []
+            if not running and not received:
+                break
+        listener.close()
+
+    def _accept(self, listener, connections, accepted):
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError:  # listener closed
+                return
+            except Exception as e:  # client died during handshake
+                logger.error(f'Error accepting status writer connection: {e}')
+                continue
+            with accepted:
+                connections.append(conn)
+
+    def _flush(self, db_file, pending, task_ids):
+        known = dict(task_ids)
+        try:
+            with db_file.batch():
+                for message in pending:
+                    self._write(db_file, message, task_ids)
+        except Exception as e:
+            # batch is rolled back, its updates are written one by one so that a bad one loses only itself
+            logger.error(f'Error writing {len(pending)} status updates in one transaction, writing them one by one: {e}')
+            task_ids.clear()
+            task_ids.update(known)  # ids of attempts started in rolled back batch are void
+            for message in pending:
+                try:
+                    self._write(db_file, message, task_ids)
+                except Exception as e:
+                    logger.error(f'Error writing status update {message[0]}: {e}')
+
+    def _write(self, db_file, message, task_ids):
+        method, args, key = message
+        if method in TASK_METHODS:
+            args = (*args[:-1], task_ids.get(args[-1], args[-1]))
+        result = getattr(db_file, method)(*args)
+        if method in ENDING_METHODS:
+            task_ids.pop(key, None)
+        elif key is not None:
+            task_ids[key] = result
+
+# if __name__ == '__main__':
+#     pass
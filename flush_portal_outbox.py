@@ -0,0 +1,19 @@
+import os
+from dotenv import load_dotenv
+from db_query.outbox import OutboxFlusher
+import json
+
+
+
+def load_config():
+    with open (os.path.join('/opt/conversion/settings', 'config.json'), 'r') as config_file:
+        config = json.load(config_file)
+        load_dotenv(os.path.join(config['path_to_main'], 'settings/.env'))
+        config['maria_db']['password'] = os.getenv('DB_PASSWORD')
+        return config
+
+flusher = OutboxFlusher(load_config())
+applied = flusher.flush()
+flusher.close()
+count, age = flusher.report_backlog()
+print(f"Applied: {applied}, left in outbox: {count}" + (f", oldest queued {age:.0f} seconds ago" if age is not None else ""))
@@ -0,0 +1,19 @@
+import argparse
+import os
+from conversion.get_info import Get_Info
+import json
+
+
+
+def load_config():
+    with open (os.path.join('/opt/conversion/settings', 'config.json'), 'r') as config_file:
+        config = json.load(config_file)
+        return config
+
+parser = argparse.ArgumentParser(description='Scan storage directory and add new files to database')
+parser.add_argument('--full', action='store_true', help='list every directory, ignoring saved directory mtimes')
+args = parser.parse_args()
+
+config = load_config()
+get_info = Get_Info(config)
+print(f"Files found: {get_info.get_all_files_info(config['directory'], full=args.full)}")
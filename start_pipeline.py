@@ -0,0 +1,22 @@
+import argparse
+import os
+from dotenv import load_dotenv
+from conversion.pipeline import ConversionPipeline
+import json
+
+
+
+def load_config():
+    with open (os.path.join('/opt/conversion/settings', 'config.json'), 'r') as config_file:
+        config = json.load(config_file)
+        load_dotenv(os.path.join(config['path_to_main'], 'settings/.env'))
+        config['maria_db']['password'] = os.getenv('DB_PASSWORD')
+        return config
+
+parser = argparse.ArgumentParser(description='Convert queued files in asyncio stages: pre-check, encode, verify and publish')
+parser.add_argument('--directory', help='convert only files of this directory')
+parser.add_argument('--policy', choices=['id', 'lpt', 'spt', 'fair'], help='order of jobs, scheduling_policy of config by default')
+args = parser.parse_args()
+
+pipeline = ConversionPipeline(load_config())
+pipeline.convert(args.directory, args.policy)
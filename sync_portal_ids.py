@@ -0,0 +1,21 @@
+import argparse
+import os
+from dotenv import load_dotenv
+from db_query.portal_sync import PortalSync
+import json
+
+
+
+def load_config():
+    with open (os.path.join('/opt/conversion/settings', 'config.json'), 'r') as config_file:
+        config = json.load(config_file)
+        load_dotenv(os.path.join(config['path_to_main'], 'settings/.env'))
+        config['maria_db']['password'] = os.getenv('DB_PASSWORD')
+        return config
+
+parser = argparse.ArgumentParser(description='Map files in database to rows of video_series_files on Stalker Portal')
+parser.add_argument('--full', action='store_true', help='read whole video_series_files table instead of rows added since last sync')
+args = parser.parse_args()
+
+matched = PortalSync(load_config()).sync(full=args.full)
+print(f"Mapped: {matched}")
@@ -0,0 +1,13 @@
+import os
+from conversion.watcher import Watcher
+import json
+
+
+
+def load_config():
+    with open (os.path.join('/opt/conversion/settings', 'config.json'), 'r') as config_file:
+        config = json.load(config_file)
+        return config
+
+watcher = Watcher(load_config())
+watcher.run()